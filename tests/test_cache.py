@@ -0,0 +1,83 @@
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.wcs import WCS
+
+import twirl.utils
+from twirl import compute_wcs
+from twirl.cache import SolutionCache, fingerprint
+
+
+def simulated_field(n=20, seed=0):
+    rng = np.random.default_rng(seed)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [120.0, 30.0]
+    wcs.wcs.crpix = [512, 512]
+    wcs.wcs.cdelt = [-1e-4, 1e-4]
+    pixels = rng.uniform(0, 1024, (n, 2))
+    radecs = np.array(wcs.pixel_to_world_values(*pixels.T)).T
+    return wcs, pixels, radecs
+
+
+def test_fingerprint_similarity_invariant():
+    _, pixels, _ = simulated_field()
+    c, s = np.cos(0.3), np.sin(0.3)
+    moved = 2.0 * pixels @ np.array([[c, -s], [s, c]]) + 15.0
+    assert fingerprint(pixels) == fingerprint(moved)
+
+
+def test_cached_solution(tmp_path, monkeypatch):
+    _, pixels, radecs = simulated_field()
+    path = tmp_path / "cache.json"
+    cache = SolutionCache(path)
+    wcs = compute_wcs(pixels, radecs, cache=cache)
+    assert len(cache) == 1
+
+    def no_search(*args, **kwargs):
+        raise AssertionError("a full search should not be performed")
+
+    monkeypatch.setattr(twirl.utils, "find_transform", no_search)
+    cached_wcs = compute_wcs(pixels + 0.5, radecs, cache=SolutionCache(path))
+    expected = np.array(wcs.world_to_pixel(SkyCoord(radecs, unit="deg"))).T + 0.5
+    solved = np.array(cached_wcs.world_to_pixel(SkyCoord(radecs, unit="deg"))).T
+    np.testing.assert_allclose(solved, expected, atol=1e-3)
+
+
+def test_cache_eviction():
+    wcs, _, _ = simulated_field()
+    cache = SolutionCache(max_size=2)
+    for key in "abc":
+        cache.put(key, wcs)
+    assert len(cache) == 2
+    assert cache.get("a") is None
+    assert cache.get("c") is not None
+
+
+def test_cache_hit_stats(tmp_path):
+    _, pixels, radecs = simulated_field()
+    path = tmp_path / "cache.json"
+    cache = SolutionCache(path)
+    _, stats = compute_wcs(pixels, radecs, cache=cache, return_stats=True)
+    assert not stats["cached"]
+    mtime = path.stat().st_mtime_ns
+
+    _, miss_stats = compute_wcs(pixels, radecs, return_stats=True)
+    _, stats = compute_wcs(pixels + 0.5, radecs, cache=cache, return_stats=True)
+    assert stats["cached"]
+    assert set(stats) == set(miss_stats) | {"cached"}
+    assert stats["flipped"] == miss_stats["flipped"]
+    assert stats["hypotheses"] == 0
+    assert stats["match_fraction"] == 1.0
+    # a cache hit does not rewrite the cache file
+    assert path.stat().st_mtime_ns == mtime
+
+
+def test_cache_hit_without_min_match():
+    _, pixels, radecs = simulated_field()
+    cache = SolutionCache()
+    compute_wcs(pixels, radecs, cache=cache)
+    wcs, stats = compute_wcs(
+        pixels, radecs, cache=cache, min_match=None, return_stats=True
+    )
+    assert wcs is not None
+    assert stats["cached"]
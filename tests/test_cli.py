@@ -0,0 +1,87 @@
+import io
+import json
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from twirl.cli import Catalogs, main, watch
+
+
+def test_daemon_stdin(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [120.0, 30.0]
+    wcs.wcs.crpix = [128, 128]
+    wcs.wcs.cdelt = [-1e-4, 1e-4]
+
+    xy = rng.uniform(10, 246, (15, 2))
+    fluxes = np.linspace(50000, 5000, len(xy))
+    y, x = np.indices((256, 256))
+    data = rng.normal(100, 5, (256, 256))
+    for (x0, y0), flux in zip(xy, fluxes):
+        data += flux / (8 * np.pi) * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / 8)
+
+    header = fits.Header({"RA": 120.0, "DEC": 30.0})
+    paths = []
+    for i in range(2):
+        paths.append(tmp_path / f"frame{i}.fits")
+        fits.PrimaryHDU(data, header=header).writeto(paths[-1])
+    radecs = np.array(wcs.pixel_to_world_values(*xy.T)).T
+    np.save(tmp_path / "catalog.npy", radecs)
+
+    monkeypatch.setattr("sys.stdin", io.StringIO("\n".join(map(str, paths))))
+    main(
+        ["--fov", "0.03", "--catalog", str(tmp_path / "catalog.npy")]
+        + ["--output", "json", "--workers", "2"]
+    )
+
+    for path in paths:
+        sidecar = json.loads(path.with_suffix(".json").read_text())
+        assert sidecar["solved"]
+        solved = WCS(fits.Header(sidecar["wcs"]))
+        np.testing.assert_allclose(
+            solved.world_to_pixel_values(*radecs.T), xy.T, atol=0.5
+        )
+
+        assert sidecar["stats"]["match_fraction"] >= 0.8
+
+    # an unrelated catalog gives a best-effort WCS that is not reported as solved
+    unrelated = radecs[0] + rng.uniform(-0.015, 0.015, radecs.shape)
+    np.save(tmp_path / "unrelated.npy", unrelated)
+    monkeypatch.setattr("sys.stdin", io.StringIO(str(paths[0])))
+    main(
+        ["--fov", "0.03", "--catalog", str(tmp_path / "unrelated.npy")]
+        + ["--output", "json", "--workers", "1", "--report", "0"]
+    )
+    sidecar = json.loads(paths[0].with_suffix(".json").read_text())
+    assert not sidecar["solved"]
+    assert sidecar["wcs"] is None
+    assert sidecar["stats"]["match_fraction"] < 0.8
+
+
+def test_watch_removed_file(tmp_path):
+    # a file listed but gone when its size is checked is skipped
+    (tmp_path / "gone.fits").symlink_to(tmp_path / "missing.fits")
+    (tmp_path / "frame.fits").write_bytes(b"0" * 2880)
+    assert next(watch(tmp_path, 0.0)) == tmp_path / "frame.fits"
+
+
+def test_catalogs_eviction(monkeypatch):
+    queries = []
+
+    def fake_gaia_radecs(center, fov):
+        queries.append(center)
+        return center.ra.deg + np.random.rand(12, 2) * 0.01
+
+    monkeypatch.setattr("twirl.cli.gaia_radecs", fake_gaia_radecs)
+    catalogs = Catalogs(12, 4, max_size=2)
+    fov = 0.1 * u.deg
+    for ra in [10, 20, 10, 30, 40, 10]:
+        catalogs.get(SkyCoord(ra, 0, unit="deg"), fov)
+    assert len(catalogs) == 2
+    # 10 was evicted by 30 and 40, being used less recently
+    assert [c.ra.deg for c in queries] == [10, 20, 30, 40, 10]
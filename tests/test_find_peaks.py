@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from twirl import find_peaks
+
+
+def simulated_image(n=20, shape=(512, 512), seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(100, 5, shape)
+    xy = rng.uniform(20, np.array(shape[::-1]) - 20, (n, 2))
+    fluxes = rng.uniform(2000, 50000, n)
+    y, x = np.indices(shape)
+    for (x0, y0), flux in zip(xy, fluxes):
+        data += flux / (8 * np.pi) * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / 8)
+    return data, xy[np.argsort(fluxes)[::-1]]
+
+
+@pytest.mark.parametrize("binning", [1, 2, 4])
+def test_binned_find_peaks(binning):
+    data, true_xy = simulated_image()
+    coords = find_peaks(data, threshold=5, binning=binning)
+    assert coords.shape[1] == 2
+    distances = np.linalg.norm(coords[:10, None] - true_xy[None, :], axis=-1)
+    assert np.all(np.min(distances, 1) < 0.2)
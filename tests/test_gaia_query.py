@@ -1 +1,101 @@
+import re
+
+import astropy.units as u
+import numpy as np
 import pytest
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+
+from twirl import gaia_radecs
+
+
+class FakeJob:
+    def __init__(self, table):
+        self.table = table
+
+    def get_results(self):
+        return self.table
+
+
+def sky_patches(rng, centers, radius=1.5, n=2000):
+    # sources uniformly spread on the sky around each center
+    ra, dec = [], []
+    for center in centers:
+        separation = radius * np.sqrt(rng.uniform(0, 1, n))
+        sources = SkyCoord(*center, unit="deg").directional_offset_by(
+            rng.uniform(0, 360, n) * u.deg, separation * u.deg
+        )
+        ra.append(sources.ra.deg)
+        dec.append(sources.dec.deg)
+    return np.concatenate(ra), np.concatenate(dec)
+
+
+@pytest.fixture
+def fake_gaia(monkeypatch):
+    astroquery_gaia = pytest.importorskip("astroquery.gaia")
+    rng = np.random.default_rng(0)
+    n = 2000
+    patch_ra, patch_dec = sky_patches(rng, [(10, 60), (0.2, 0)])
+    catalog = Table(
+        {
+            "ra": np.concatenate([rng.uniform(9, 11, n), patch_ra]),
+            "dec": np.concatenate([rng.uniform(-1, 1, n), patch_dec]),
+        }
+    )
+    catalog["source_id"] = np.arange(len(catalog))
+    catalog["pmra"] = catalog["pmdec"] = np.zeros(len(catalog))
+    catalog["phot_g_mean_mag"] = rng.uniform(5, 20, len(catalog))
+    catalog["ra"].unit = catalog["dec"].unit = "deg"
+
+    def launch_job(query):
+        limit = int(re.search(r"top (\d+)", query).group(1))
+        ra_min, ra_max = map(
+            float, re.search(r"ra >= (\S+) AND gaia.ra < (\S+) ", query).groups()
+        )
+        dec_min, dec_max = map(
+            float, re.search(r"dec >= (\S+) AND gaia.dec < (\S+)\s", query).groups()
+        )
+        mask = (catalog["ra"] >= ra_min) & (catalog["ra"] < ra_max)
+        mask &= (catalog["dec"] >= dec_min) & (catalog["dec"] < dec_max)
+        table = catalog[mask]
+        table.sort("phot_g_mean_mag")
+        return FakeJob(table[0:limit])
+
+    monkeypatch.setattr(astroquery_gaia.Gaia, "launch_job", launch_job)
+    return catalog
+
+
+def test_tiled_query(fake_gaia):
+    radecs, mags = gaia_radecs(
+        (10, 0), 1.0, limit=100, circular=False, tiles=4, magnitude=True
+    )
+    assert len(radecs) == 100
+    assert np.all(np.diff(mags) >= 0)
+    assert len(np.unique(radecs, axis=0)) == len(radecs)
+    # each of the 16 tiles contributes its brightest sources
+    tiles_ra = np.floor((radecs[:, 0] - 9.5) * 4)
+    tiles_dec = np.floor((radecs[:, 1] + 0.5) * 4)
+    assert len(set(zip(tiles_ra, tiles_dec))) == 16
+
+
+def test_tiled_circular_query(fake_gaia):
+    radecs = gaia_radecs((10, 0), 1.0, tiles=3)
+    distances = np.hypot(radecs[:, 0] - 10, radecs[:, 1])
+    assert np.all(distances <= 0.5 + 1e-6)
+
+
+def test_tiled_circular_limit(fake_gaia):
+    # tiles only partly within the circle get more sources, so that about `limit`
+    # sources are returned in the circle
+    radecs = gaia_radecs((10, 0), 1.0, limit=100, tiles=4)
+    assert len(radecs) == 100
+
+
+@pytest.mark.parametrize("center", [(10, 60), (0.2, 0)])
+def test_tiled_circular_coverage(fake_gaia, center):
+    # high declination and RA=0/360 crossing fields
+    radecs = gaia_radecs(center, 1.0, tiles=3)
+    separation = SkyCoord(fake_gaia["ra"], fake_gaia["dec"]).separation(
+        SkyCoord(*center, unit="deg")
+    )
+    assert len(radecs) == np.count_nonzero(separation.deg <= 0.5)
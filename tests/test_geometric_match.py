@@ -1,8 +1,19 @@
+import tracemalloc
+
 import numpy as np
 import pytest
+from scipy.spatial import cKDTree
 
 from twirl.geometry import pad, transform_matrix
-from twirl.match import count_cross_match, find_transform
+from twirl.index import HashGrid, asterism_cost, asterism_hashes
+from twirl.match import (
+    _prior,
+    candidate_pairs,
+    count_cross_match,
+    find_transform,
+    refine_transform,
+)
+from twirl.quints import hashes as quint_hashes
 
 
 @pytest.mark.parametrize("asterism", [3, 4])
@@ -196,3 +207,247 @@ def test_realistic_match():
 
     M = find_transform(radecs, pixels, tolerance=10, asterism=4, quads_tolerance=0.1)
     assert count_cross_match(pixels, (M @ pad(radecs).T)[0:2].T, tol=10) == 9
+
+
+@pytest.mark.parametrize("max_memory", [1e3, 2**28])
+def test_candidate_pairs(max_memory):
+    np.random.seed(0)
+    hashes1 = np.random.rand(500, 4)
+    hashes2 = np.random.rand(400, 4)
+    tree2 = cKDTree(hashes2)
+    expected = cKDTree(hashes1).query_ball_tree(tree2, r=0.1)
+    expected = sorted((i, j) for i, js in enumerate(expected) for j in js)
+
+    chunks = list(candidate_pairs(hashes1, tree2, 0.1, max_memory=max_memory))
+    pairs = [(i, j) for ii, jj, _ in chunks for i, j in zip(ii, jj)]
+    assert pairs == expected
+    if max_memory < 1e4:
+        assert len(chunks) > 1
+
+
+def test_refine_transform():
+    np.random.seed(0)
+    n = 40
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=800.0, rotation=0.3, translation=(30, 10))
+    xy2 = (true_M @ pad(xy1).T)[0:2].T + np.random.normal(0, 0.3, (n, 2))
+    # a few spurious sources and a slightly wrong initial transform
+    xy2 = np.vstack([xy2, 800 * np.random.rand(10, 2)])
+    M0 = transform_matrix(scale=803.0, rotation=0.302, translation=(33, 8))
+
+    M, matches, stats = refine_transform(M0, xy1, xy2, tolerance=10)
+    assert stats["converged"]
+    assert stats["rms"] < 1.0
+    assert stats["n_matches"] >= 0.9 * n
+    np.testing.assert_array_equal(matches[:, 0], matches[:, 1])
+
+
+def test_uniform_match(n=100, seed=2):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    # brightest stars bunched in a corner of the field
+    xy1 = xy1[np.argsort(np.sum(xy1, 1))]
+    true_M = transform_matrix(scale=8.0, rotation=np.pi, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(xy1).T)[0:2].T + 0.002 * np.random.rand(n, 2)
+
+    # only the pixels asterisms are built from uniformly spread stars
+    M = find_transform(xy1[0:40], xy2, tolerance=0.02, uniform=12)
+    cn = count_cross_match((M @ pad(xy1).T)[0:2].T, xy2, tol=0.02)
+    assert cn > 0.8 * n
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_uniform_larger_catalog(seed):
+    # the catalog covers twice the size of the image
+    rng = np.random.default_rng(seed)
+    xy1 = rng.uniform(-0.5, 1.5, (200, 2))
+    inside = np.all((xy1 > 0) & (xy1 < 1), axis=1)
+    true_M = transform_matrix(scale=8.0, rotation=np.pi, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(xy1[inside]).T)[0:2].T + 0.002 * rng.random((inside.sum(), 2))
+
+    M = find_transform(xy1[0:60], xy2, tolerance=0.02, uniform=12)
+    cn = count_cross_match((M @ pad(xy1).T)[0:2].T, xy2, tol=0.02)
+    assert cn > 0.8 * len(xy2)
+
+
+@pytest.mark.parametrize("r", [0.05, 0.1, 0.25])
+@pytest.mark.parametrize("d", [4, 6])
+def test_hash_grid(r, d, tmp_path):
+    np.random.seed(0)
+    hashes1 = np.random.rand(300, d)
+    hashes2 = np.random.rand(400, d)
+    tree2 = cKDTree(hashes2)
+    expected = cKDTree(hashes1).query_ball_tree(tree2, r=r)
+    expected = sorted((i, j) for i, js in enumerate(expected) for j in js)
+
+    HashGrid(hashes2, 0.1).save(tmp_path / "grid.npz")
+    grid = HashGrid.load(tmp_path / "grid.npz")
+    if r > grid.width:
+        with pytest.warns(UserWarning):
+            i, j, distances = grid.query(hashes1, r)
+    else:
+        i, j, distances = grid.query(hashes1, r)
+    assert list(zip(i, j)) == expected
+    np.testing.assert_allclose(
+        distances, np.linalg.norm(hashes1[i] - hashes2[j], axis=1)
+    )
+
+
+@pytest.mark.parametrize("asterism", [3, 4])
+def test_hash_grid_match(asterism, n=12, seed=5, extra=5):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=8.0, rotation=np.pi, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(np.array([*xy1, *np.random.rand(extra, 2)])).T)[0:2].T
+    np.random.shuffle(xy2)
+
+    M = find_transform(xy1, xy2, tolerance=0.01, asterism=asterism, hash_grid=True)
+    np.testing.assert_allclose(M, true_M, atol=1e-6)
+
+
+@pytest.mark.parametrize("best_first", [True, False])
+def test_best_first(best_first, n=20, seed=1):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=8.0, rotation=0.5, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(xy1).T)[0:2].T
+    # spurious sources among the brightest pixels
+    xy2 = np.insert(xy2, [2, 5], 8 * np.random.rand(2, 2), axis=0)
+
+    M = find_transform(xy1, xy2, tolerance=0.01, best_first=best_first)
+    np.testing.assert_allclose(M, true_M, atol=1e-6)
+
+
+def test_best_first_prior():
+    # equally bright asterisms reordered, the prior follows their A-B length rank
+    members = np.array([[0, 1, 2, 3], [0, 1, 2, 3], [3, 2, 1, 0]])
+    size_rank = np.array([2, 0, 1])
+    assert list(np.argsort(_prior(members, size_rank))) == [1, 2, 0]
+
+
+def test_search_budget(n=20, seed=3):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=8.0, rotation=0.5, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(np.array([*xy1, *np.random.rand(10, 2)])).T)[0:2].T
+    np.random.shuffle(xy2)
+
+    M, stats = find_transform(xy1, xy2, tolerance=0.01, return_stats=True)
+    assert stats["exhaustive"]
+    assert stats["match_fraction"] >= 0.6
+
+    M, stats = find_transform(
+        xy1, xy2, tolerance=0.01, min_match=1.0, max_hypotheses=5, return_stats=True
+    )
+    assert stats["hypotheses"] == 5
+    assert not stats["exhaustive"]
+
+    with pytest.warns(UserWarning):
+        M, stats = find_transform(
+            xy1, xy2, tolerance=0.01, min_match=1.0, time_budget=0.0, return_stats=True
+        )
+    assert M is None
+    assert stats["hypotheses"] == 0
+    assert not stats["exhaustive"]
+
+
+@pytest.mark.parametrize("asterism", [3, 4, 5])
+def test_asterism_cost(asterism, n=30):
+    cost = asterism_cost(n, asterism)
+    tracemalloc.start()
+    hashes, _, _ = asterism_hashes(np.random.rand(n, 2), asterism)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(hashes) <= cost["count"]
+    # an upper bound, the actual peak depending on the numpy version
+    assert peak <= cost["memory"]
+
+
+def test_memory_budget(n=40, seed=4):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=8.0, rotation=0.5, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(xy1).T)[0:2].T
+
+    M, stats = find_transform(xy1, xy2, tolerance=0.01, return_stats=True)
+    assert not stats["capped"]
+    assert stats["n_stars"] == n
+
+    # quads of the 20 brightest stars only
+    max_memory = 2 * asterism_cost(20, 4)["memory"]
+    with pytest.warns(UserWarning):
+        M, stats = find_transform(
+            xy1, xy2, tolerance=0.01, max_memory=max_memory, return_stats=True
+        )
+    assert stats["capped"]
+    assert (stats["n_stars"], stats["asterism"]) == (20, 4)
+    assert stats["match_fraction"] >= 0.7
+
+    # too small for quads, triangles are used instead
+    max_memory = 2 * asterism_cost(15, 3)["memory"]
+    with pytest.warns(UserWarning):
+        M, stats = find_transform(
+            xy1, xy2, tolerance=0.01, max_memory=max_memory, return_stats=True
+        )
+    assert (stats["n_stars"], stats["asterism"]) == (15, 3)
+    assert stats["match_fraction"] >= 0.7
+
+
+@pytest.mark.parametrize("asterism", [3, 4, 5])
+def test_mirrored_match(asterism, n=25, seed=2):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=8.0, rotation=0.5, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(np.array([*xy1, *np.random.rand(5, 2)])).T)[0:2].T
+    mirrored = xy2 * [-1, 1]
+
+    _, stats = find_transform(
+        xy1, xy2, tolerance=0.02, asterism=asterism, return_stats=True
+    )
+    M, mirrored_stats = find_transform(
+        xy1, mirrored, tolerance=0.02, asterism=asterism, return_stats=True
+    )
+    assert not stats["flipped"]
+    assert mirrored_stats["flipped"]
+    assert mirrored_stats["hypotheses"] == stats["hypotheses"]
+    cn = count_cross_match((M @ pad(xy1).T)[0:2].T, mirrored, tol=0.02)
+    assert cn >= 0.8 * n
+
+
+def test_quint_hashes(n=30, seed=1):
+    np.random.seed(seed)
+    xy = np.random.rand(n, 2)
+    M = transform_matrix(scale=3.0, rotation=0.7, translation=(5.0, 1.0))
+    moved = (M @ pad(xy).T)[0:2].T
+    hashes1, _, members1 = quint_hashes(xy, return_indices=True)
+    for coords in (moved, moved * [-1, 1]):
+        hashes2, quints2, members2 = quint_hashes(coords, return_indices=True)
+        np.testing.assert_allclose(quints2, coords[members2])
+        # same asterisms, with their points in the same order
+        order1 = np.lexsort(np.sort(members1, axis=1).T)
+        order2 = np.lexsort(np.sort(members2, axis=1).T)
+        np.testing.assert_array_equal(members1[order1], members2[order2])
+        np.testing.assert_allclose(hashes1[order1], hashes2[order2], atol=1e-9)
+
+
+def test_dense_match(n=150, seed=0):
+    rng = np.random.default_rng(seed)
+    xy1 = rng.random((n, 2))
+    true_M = transform_matrix(scale=8.0, rotation=0.5, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(np.array([*xy1, *rng.random((50, 2))])).T)[0:2].T
+    xy2 += rng.normal(0, 0.002, xy2.shape)
+    xy2 = xy2[rng.permutation(len(xy2))]
+
+    M, stats = find_transform(
+        xy1[0:130], xy2, tolerance=0.03, asterism=5, min_match=0.5, return_stats=True
+    )
+    assert stats["match_fraction"] >= 0.5
+    assert stats["hypotheses"] < 10
+
+
+def test_hash_grid_too_many_bins():
+    # 10^4 bins per dimension, i.e. 10^24 bins, do not fit in int64 keys
+    hashes = np.random.rand(100, 6)
+    with pytest.raises(ValueError):
+        HashGrid(hashes, 1e-4)
+    assert len(HashGrid(hashes, 1e-3)) == 100
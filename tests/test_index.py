@@ -0,0 +1,82 @@
+import multiprocessing
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from twirl.geometry import pad, transform_matrix
+from twirl.index import (
+    HashGrid,
+    SharedIndex,
+    _tracker_id,
+    attach_index,
+    build_index,
+    load_index,
+    save_index,
+)
+from twirl.match import find_transform
+
+
+def simulated_points(n=12, seed=5, extra=5):
+    np.random.seed(seed)
+    xy1 = np.random.rand(n, 2)
+    true_M = transform_matrix(scale=8.0, rotation=np.pi, translation=(0.3, 0.1))
+    xy2 = (true_M @ pad(np.array([*xy1, *np.random.rand(extra, 2)])).T)[0:2].T
+    np.random.shuffle(xy2)
+    return xy1, xy2, true_M
+
+
+def shares_tracker(handle):
+    # attaching in a child must keep the publisher registration of the memory
+    attach_index(handle)
+    return _tracker_id() == handle["tracker"]
+
+
+def solve(args):
+    handle, xy1, xy2 = args
+    return find_transform(xy1, xy2, tolerance=0.01, index=attach_index(handle))
+
+
+def test_saved_index(tmp_path):
+    xy1, xy2, true_M = simulated_points()
+    save_index(build_index(xy1), tmp_path / "index")
+    index = load_index(tmp_path / "index")
+    assert isinstance(index.lookup, cKDTree)
+    assert isinstance(index.hashes, np.memmap)
+    M = find_transform(xy1, xy2, tolerance=0.01, index=index)
+    np.testing.assert_allclose(M, true_M, atol=1e-6)
+
+
+def test_shared_grid_index(tmp_path):
+    xy1, _, _ = simulated_points()
+    grid = build_index(xy1, grid=0.02).lookup
+    with SharedIndex(build_index(xy1, grid=0.02)) as shared:
+        index = attach_index(shared.handle)
+        assert attach_index(shared.handle) is index
+        assert isinstance(index.lookup, HashGrid)
+        assert index.lookup.width == 0.02
+        # the grid arrays are shared rather than rebuilt
+        assert not index.lookup.keys.flags.writeable
+        np.testing.assert_array_equal(index.lookup.keys, grid.keys)
+        np.testing.assert_array_equal(index.lookup.order, grid.order)
+
+    save_index(build_index(xy1, grid=0.02), tmp_path / "index")
+    index = load_index(tmp_path / "index")
+    assert isinstance(index.lookup.keys, np.memmap)
+    np.testing.assert_array_equal(index.lookup.keys, grid.keys)
+
+
+def test_shared_index():
+    xy1, xy2, true_M = simulated_points()
+    with SharedIndex(build_index(xy1)) as shared:
+        index = attach_index(shared.handle)
+        assert isinstance(index.lookup, cKDTree)
+        assert not index.hashes.flags.writeable
+        np.testing.assert_allclose(
+            find_transform(xy1, xy2, tolerance=0.01, index=index), true_M, atol=1e-6
+        )
+
+        with multiprocessing.get_context("spawn").Pool(2) as pool:
+            results = pool.map(solve, [(shared.handle, xy1, xy2)] * 2)
+            assert all(pool.map(shares_tracker, [shared.handle] * 2))
+    for M in results:
+        np.testing.assert_allclose(M, true_M, atol=1e-6)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from astropy.wcs import WCS
+
+from twirl.tracking import Tracker
+
+
+def stars_image(xy, fluxes, shape=(256, 256), seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.indices(shape)
+    data = rng.normal(100, 5, shape)
+    for (x0, y0), flux in zip(xy, fluxes):
+        data += flux * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / 8)
+    return data
+
+
+@pytest.fixture
+def field():
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(-20, 276, (80, 2))
+    fluxes = rng.uniform(50, 2000, len(xy))
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [10.0, 20.0]
+    wcs.wcs.crpix = [100, 150]
+    wcs.wcs.cdelt = [-1e-4, 1e-4]
+    return xy, fluxes, wcs
+
+
+@pytest.mark.parametrize("rotation", [False, True])
+def test_tracked_offset(field, rotation):
+    xy, fluxes, wcs = field
+    tracker = Tracker(stars_image(xy, fluxes), wcs, rotation=rotation, binning=2)
+    angle = np.deg2rad(3.0) if rotation else 0.0
+    c, s = np.cos(angle), np.sin(angle)
+    center = np.array([127.5, 127.5])
+    offset = np.array([3.3, -5.6])
+    new_xy = (xy - center) @ np.array([[c, -s], [s, c]]).T + center + offset
+
+    new_wcs = tracker.update(stars_image(new_xy, fluxes, seed=1))
+    assert tracker.quality > tracker.min_quality
+    np.testing.assert_allclose(tracker.angle, angle, atol=np.deg2rad(0.1))
+    inside = np.all((xy > 30) & (xy < 226), axis=1)
+    radecs = wcs.pixel_to_world_values(*xy[inside].T)
+    tracked_xy = np.array(new_wcs.world_to_pixel_values(*radecs)).T
+    np.testing.assert_allclose(tracked_xy, new_xy[inside], atol=0.5)
+
+
+def test_resolve_on_low_quality(field):
+    xy, fluxes, wcs = field
+    solved = []
+
+    def solve(data):
+        solved.append(data)
+        return wcs
+
+    tracker = Tracker(stars_image(xy, fluxes), wcs, solve=solve)
+    other_field = np.random.default_rng(1).uniform(0, 256, (80, 2))
+    new_wcs = tracker.update(stars_image(other_field, fluxes, seed=2))
+    assert tracker.solved
+    assert len(solved) == 1
+    assert new_wcs is wcs
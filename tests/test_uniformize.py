@@ -0,0 +1,35 @@
+import numpy as np
+
+from twirl.geometry import uniformize
+from twirl.index import build_index
+
+
+def test_uniformize_round_robin():
+    # the 4 brightest points are in the same corner
+    coords = np.array(
+        [[0.1, 0.1], [0.2, 0.1], [0.1, 0.2], [0.2, 0.2], [0.9, 0.9], [0.9, 0.1]]
+    )
+    selected = uniformize(coords, 3, cells=2)
+    np.testing.assert_array_equal(selected, coords[[0, 4, 5]])
+
+
+def test_uniformize_covers_field():
+    np.random.seed(0)
+    coords = np.random.rand(200, 2)
+    # sort by a brightness biased toward one corner
+    coords = coords[np.argsort(np.sum(coords, 1))]
+    selected = uniformize(coords, 16)
+    assert len(selected) == 16
+    cells = set(map(tuple, np.minimum((selected * 4).astype(int), 3)))
+    assert len(cells) == 16
+
+
+def test_uniform_index_members():
+    np.random.seed(0)
+    coords = np.random.rand(50, 2)
+    selected, indices = uniformize(coords, 16, return_indices=True)
+    np.testing.assert_array_equal(coords[indices], selected)
+    # the index members refer to its stored coords, not to the selected ones
+    index = build_index(coords, uniform=16)
+    assert len(index.coords) == 50
+    np.testing.assert_array_equal(index.coords[index.members], index.asterisms)
@@ -1,3 +1,5 @@
+from twirl.cache import SolutionCache
 from twirl.geometry import sparsify
 from twirl.queries import gaia_radecs
+from twirl.tracking import Tracker
 from twirl.utils import compute_wcs, find_peaks
@@ -0,0 +1,115 @@
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy.spatial.distance import pdist
+
+
+def fingerprint(pixel_coords: np.ndarray, n: int = 5, precision: float = 0.05) -> tuple:
+    """
+    Geometric fingerprint of the brightest detections.
+
+    The fingerprint is made of the sorted pairwise distances of the `n` first
+    (i.e. brightest) coordinates, normalized by the largest one and quantized
+    to `precision`. It is invariant to translation, rotation and scale.
+
+    Parameters
+    ----------
+    pixel_coords : np.ndarray
+        Pixel coordinates of the detections sorted by decreasing flux, shape (m, 2).
+    n : int, optional
+        Number of brightest detections to use, by default 5.
+    precision : float, optional
+        Quantization step of the normalized distances, by default 0.05.
+
+    Returns
+    -------
+    tuple
+        The fingerprint, as a tuple of integers.
+    """
+    distances = np.sort(pdist(pixel_coords[:n]))
+    if len(distances) == 0 or distances[-1] == 0:
+        return ()
+    return tuple(np.round(distances / distances[-1] / precision).astype(int).tolist())
+
+
+class SolutionCache:
+    """
+    Size-bounded cache of WCS solutions, keyed on a coarse pointing bin and a
+    geometric fingerprint of the brightest detections.
+
+    Cached solutions are only used as a starting hypothesis by
+    :func:`twirl.compute_wcs`, which verifies them by cross-match before
+    accepting them.
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        JSON file in which the cache is persisted. If it exists, it is loaded. By
+        default None (in-memory cache).
+    max_size : int, optional
+        Maximum number of solutions kept, the least recently used ones being
+        evicted first, by default 256.
+    resolution : float, optional
+        Size of the pointing bins in degrees, by default 0.5.
+    n : int, optional
+        Number of brightest detections used for the fingerprint, by default 5.
+    precision : float, optional
+        Quantization step of the fingerprint, by default 0.05.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Union[str, Path]] = None,
+        max_size: int = 256,
+        resolution: float = 0.5,
+        n: int = 5,
+        precision: float = 0.05,
+    ):
+        self.path = None if path is None else Path(path)
+        self.max_size = max_size
+        self.resolution = resolution
+        self.n = n
+        self.precision = precision
+        self._entries = OrderedDict()
+
+        if self.path is not None and self.path.exists():
+            self._entries.update(json.loads(self.path.read_text()))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, center: SkyCoord, pixel_coords: np.ndarray) -> str:
+        """Cache key of a pointing and its detections."""
+        ra_bin = int(np.floor(center.ra.deg / self.resolution))
+        dec_bin = int(np.floor(center.dec.deg / self.resolution))
+        code = fingerprint(pixel_coords, n=self.n, precision=self.precision)
+        return f"{ra_bin}:{dec_bin}:" + "-".join(map(str, code))
+
+    def get(self, key: str) -> Optional[WCS]:
+        """Return the WCS cached under `key`, or None."""
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return WCS(fits.Header.fromstring(self._entries[key]))
+
+    def put(self, key: str, wcs: WCS):
+        """Cache `wcs` under `key`, evicting the least recently used solutions."""
+        self._entries[key] = wcs.to_header_string(relax=True)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        if self.path is not None:
+            self.save()
+
+    def save(self):
+        """Write the cache to its `path`."""
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self._entries))
+        os.replace(tmp, self.path)
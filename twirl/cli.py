@@ -0,0 +1,331 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+
+from twirl.queries import gaia_radecs
+from twirl.utils import catalog_index, compute_wcs, find_peaks
+
+FITS_SUFFIXES = (".fits", ".fit", ".fts")
+
+
+class Catalogs:
+    """
+    In-memory store of the catalog stars and their asterisms index, queried once
+    per pointing and kept warm across frames.
+
+    Catalogs of different pointings are queried concurrently, while the threads
+    needing the catalog of the same pointing wait for a single query. Only the
+    `max_size` most recently used catalogs are kept.
+
+    Parameters
+    ----------
+    n : int
+        Number of (brightest) catalog stars to keep.
+    asterism : int
+        Asterism used to build the indices.
+    radecs : np.ndarray, optional
+        Fixed catalog used for all frames, shape (m, 2). If None, the Gaia catalog
+        is queried around each frame pointing.
+    resolution : float, optional
+        Fraction of the field of view below which two pointings share the same
+        catalog, by default 0.25.
+    max_size : int, optional
+        Maximum number of catalogs kept, by default 64.
+    """
+
+    def __init__(self, n, asterism, radecs=None, resolution=0.25, max_size=64):
+        self.n = n
+        self.asterism = asterism
+        self.resolution = resolution
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._catalogs = OrderedDict()
+        if radecs is not None:
+            radecs = radecs[0 : self.n]
+            self._fixed = (radecs, catalog_index(radecs, asterism))
+        else:
+            self._fixed = None
+
+    def __len__(self):
+        return len(self._catalogs)
+
+    def get(self, center, fov):
+        """Return the catalog RA-DEC coordinates and index of a pointing."""
+        if self._fixed is not None:
+            return self._fixed
+
+        step = self.resolution * fov.to(u.deg).value
+        key = (
+            int(np.round(center.ra.deg / step)),
+            int(np.round(center.dec.deg / step)),
+            int(np.round(np.log2(fov.to(u.deg).value) * 4)),
+        )
+        # the global lock only guards the per-pointing locks, not the queries
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            with self._lock:
+                catalog = self._catalogs.get(key)
+                if catalog is not None:
+                    self._catalogs.move_to_end(key)
+            if catalog is None:
+                radecs = gaia_radecs(center, 1.2 * fov)[0 : self.n]
+                catalog = (radecs, catalog_index(radecs, self.asterism))
+                with self._lock:
+                    self._catalogs[key] = catalog
+                    while len(self._catalogs) > self.max_size:
+                        evicted, _ = self._catalogs.popitem(last=False)
+                        self._locks.pop(evicted, None)
+        return catalog
+
+
+class Stats:
+    """Throughput and latency figures of the solved frames."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.latencies = []
+        self.solved = 0
+
+    def record(self, latency, solved):
+        with self._lock:
+            self.latencies.append(latency)
+            self.solved += int(solved)
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.perf_counter() - self.start
+            n = len(self.latencies)
+            if n == 0:
+                return "no frames processed"
+            median, p90 = np.percentile(self.latencies, [50, 90])
+            return (
+                f"{n} frames ({self.solved} solved) in {elapsed:.1f} s: "
+                f"{n / elapsed:.2f} frames/s, latency median {median:.3f} s, "
+                f"p90 {p90:.3f} s"
+            )
+
+
+def _jsonable(stats):
+    # numpy scalars as python ones and non-finite values as None
+    values = {}
+    for key, value in stats.items():
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and not np.isfinite(value):
+            value = None
+        values[key] = value
+    return values
+
+
+def solve(path, catalogs, args):
+    """
+    Solve a FITS file and write its WCS, returning whether it was solved.
+
+    A frame is solved if at least `args.min_match` of its detections are matched,
+    compute_wcs returning its best solution even when the search failed or was
+    stopped by the time budget.
+    """
+    header = fits.getheader(path)
+    data = fits.getdata(path).astype(float)
+
+    center = SkyCoord(header[args.ra_key], header[args.dec_key], unit=["deg", "deg"])
+    if args.fov is not None:
+        fov = args.fov * u.deg
+    else:
+        fov = np.max(data.shape) * (args.pixel_scale * u.arcsec).to(u.deg)
+
+    radecs, index = catalogs.get(center, fov)
+    pixels = find_peaks(data, threshold=args.threshold, binning=args.binning)
+    pixels = pixels[0 : args.n_stars]
+    wcs, stats = compute_wcs(
+        pixels,
+        radecs,
+        tolerance=args.tolerance,
+        asterism=args.asterism,
+        min_match=args.min_match,
+        index=index,
+        time_budget=args.time_budget,
+        return_stats=True,
+    )
+    solved = wcs is not None and bool(stats["match_fraction"] >= args.min_match)
+
+    path = Path(path)
+    if args.output == "json":
+        sidecar = {
+            "file": path.name,
+            "solved": solved,
+            "n_sources": len(pixels),
+            "stats": _jsonable(stats),
+            "wcs": dict(wcs.to_header()) if solved else None,
+        }
+        path.with_suffix(".json").write_text(json.dumps(sidecar, indent=2))
+    elif solved:
+        fits.PrimaryHDU(header=wcs.to_header()).writeto(
+            path.with_suffix(".wcs"), overwrite=True
+        )
+
+    return solved
+
+
+# catalogs and arguments of a worker process, kept warm across frames
+_worker = {}
+
+
+def init_worker(args, radecs):
+    """Set up the catalogs of a worker process."""
+    _worker["args"] = args
+    _worker["catalogs"] = Catalogs(args.n_catalog, args.asterism, radecs=radecs)
+
+
+def solve_frame(path):
+    """Solve a frame in a worker process, returning (solved, latency, error)."""
+    t0 = time.perf_counter()
+    try:
+        solved, error = solve(path, _worker["catalogs"], _worker["args"]), None
+    except Exception as e:
+        solved, error = False, str(e)
+    return solved, time.perf_counter() - t0, error
+
+
+def watch(directory, poll):
+    """Yield the FITS files appearing in `directory`, once they are fully written."""
+    seen = set()
+    sizes = {}
+    while True:
+        for path in sorted(Path(directory).iterdir()):
+            if path in seen or path.suffix.lower() not in FITS_SUFFIXES:
+                continue
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                # renamed or removed since listed
+                sizes.pop(path, None)
+                continue
+            if sizes.get(path) == size:
+                seen.add(path)
+                del sizes[path]
+                yield path
+            else:
+                sizes[path] = size
+        time.sleep(poll)
+
+
+def stdin_paths():
+    """Yield the paths read from the standard input, one per line."""
+    for line in sys.stdin:
+        if line.strip():
+            yield Path(line.strip())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="twirl",
+        description=(
+            "Plate solving daemon: solves incoming FITS files, keeping catalogs "
+            "and asterisms indices in memory across frames."
+        ),
+    )
+    parser.add_argument(
+        "directory",
+        nargs="?",
+        help="directory to watch (paths read from stdin if omitted)",
+    )
+    fov = parser.add_mutually_exclusive_group(required=True)
+    fov.add_argument("--fov", type=float, help="field of view in degrees")
+    fov.add_argument("--pixel-scale", type=float, help="pixel scale in arcseconds")
+    parser.add_argument(
+        "--catalog", help="npy file of RA-DEC coordinates used instead of Gaia queries"
+    )
+    parser.add_argument("--ra-key", default="RA", help="header key of the RA (deg)")
+    parser.add_argument("--dec-key", default="DEC", help="header key of the DEC (deg)")
+    parser.add_argument("--n-stars", type=int, default=12, help="detections used")
+    parser.add_argument("--n-catalog", type=int, default=12, help="catalog stars used")
+    parser.add_argument("--threshold", type=float, default=2.0)
+    parser.add_argument("--binning", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=5)
+    parser.add_argument(
+        "--min-match",
+        type=float,
+        default=0.8,
+        help="fraction of detections matched for a frame to be solved",
+    )
+    parser.add_argument("--asterism", type=int, default=4, choices=[3, 4, 5])
+    parser.add_argument(
+        "--time-budget", type=float, help="maximum asterisms search duration (s)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="number of worker processes, each keeping its own catalogs",
+    )
+    parser.add_argument("--output", default="header", choices=["header", "json"])
+    parser.add_argument("--poll", type=float, default=1.0, help="polling period (s)")
+    parser.add_argument(
+        "--report",
+        type=int,
+        default=10,
+        help="report figures every n frames (0 to only report on exit)",
+    )
+    args = parser.parse_args(argv)
+    if args.report < 0 or args.workers < 1:
+        parser.error("--report must be >= 0 and --workers >= 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    radecs = None if args.catalog is None else np.load(args.catalog)
+    stats = Stats()
+
+    def report(path, future):
+        try:
+            solved, latency, error = future.result()
+        except Exception as e:
+            # e.g. a worker process that died
+            solved, latency, error = False, 0.0, str(e)
+        if error is not None:
+            print(f"{path}: failed ({error})", file=sys.stderr)
+        stats.record(latency, solved)
+        print(
+            f"{path}: {'solved' if solved else 'not solved'} in {latency:.3f} s",
+            file=sys.stderr,
+        )
+        if args.report > 0 and len(stats.latencies) % args.report == 0:
+            print(stats.summary(), file=sys.stderr)
+
+    paths = (
+        stdin_paths() if args.directory is None else watch(args.directory, args.poll)
+    )
+
+    # the asterisms search is CPU-bound, hence processes rather than threads
+    pool = ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_worker, initargs=(args, radecs)
+    )
+    try:
+        for path in paths:
+            future = pool.submit(solve_frame, path)
+            future.add_done_callback(lambda future, path=path: report(path, future))
+        pool.shutdown(wait=True)
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+    finally:
+        print(stats.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
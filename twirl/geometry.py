@@ -1,3 +1,5 @@
+from typing import Optional
+
 import numpy as np
 
 
@@ -156,3 +158,59 @@ def sparsify(coords: np.ndarray, radius: float) -> np.ndarray:
             deleted_coords = np.hstack([deleted_coords, idxs])
 
     return np.array(sparse_coords)
+
+
+def uniformize(
+    coords: np.ndarray,
+    n: int,
+    cells: Optional[int] = None,
+    return_indices: bool = False,
+) -> np.ndarray:
+    """
+    Returns `n` coordinates spread uniformly over the field, selected round-robin
+    over the cells of a grid, from the first (e.g. brightest) to the last.
+
+    Parameters:
+    -----------
+    coords : np.ndarray
+        The input array of shape (m, 2) containing the coordinates of the points,
+        sorted by priority (e.g. by decreasing flux).
+    n : int
+        The number of coordinates to select.
+    cells : int, optional
+        The number of cells along each axis of the grid, by default `ceil(sqrt(n))`.
+    return_indices : bool, optional
+        Whether to also return the indices of the selected coordinates in `coords`,
+        by default False.
+
+    Returns:
+    --------
+    np.ndarray
+        The selected coordinates of shape (min(n, m), 2), sorted by their rank in
+        their cell and then by their input order.
+    np.ndarray
+        Only if `return_indices` is True, the indices of the selected coordinates
+        in `coords`.
+    """
+    if cells is None:
+        cells = int(np.ceil(np.sqrt(n)))
+
+    lower = coords.min(0)
+    span = coords.max(0) - lower
+    span[span == 0] = 1.0
+    ij = np.minimum((cells * (coords - lower) / span).astype(int), cells - 1)
+    cell = ij[:, 0] + cells * ij[:, 1]
+
+    # rank of each point within its cell, following the input order
+    order = np.argsort(cell, kind="stable")
+    sorted_cell = cell[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])
+    counts = np.diff(np.r_[starts, len(cell)])
+    rank = np.empty(len(cell), dtype=int)
+    rank[order] = np.arange(len(cell)) - np.repeat(starts, counts)
+
+    selected = np.lexsort((np.arange(len(coords)), rank))[0:n]
+    if return_indices:
+        return coords[selected], selected
+    else:
+        return coords[selected]
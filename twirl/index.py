@@ -0,0 +1,485 @@
+import json
+import os
+import sys
+import warnings
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from twirl.geometry import uniformize
+from twirl.quads import cost as cost4
+from twirl.quads import hashes as hash4
+from twirl.quints import cost as cost5
+from twirl.quints import hashes as hash5
+from twirl.triangles import cost as cost3
+from twirl.triangles import hashes as hash3
+
+
+def asterism_hashes(coords: np.ndarray, asterism: int = 4):
+    """
+    Computes the asterisms hashes of a set of coordinates.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Coordinates of the points, shape (n, 2).
+    asterism : int, optional
+        The asterism to use for hashing, either 3, 4 or 5, by default 4.
+
+    Returns
+    -------
+    hashes : np.ndarray
+        The hashes of the asterisms.
+    asterisms : np.ndarray
+        The coordinates of the asterisms points, shape (n_asterisms, asterism, 2).
+    members : np.ndarray
+        The indices of the asterisms points in `coords`, shape (n_asterisms, asterism).
+    """
+    if asterism == 3:
+        return hash3(coords, return_indices=True)
+    elif asterism == 4:
+        return hash4(coords, return_indices=True)
+    elif asterism == 5:
+        return hash5(coords, return_indices=True)
+    else:
+        raise ValueError("available asterisms are 3, 4 and 5")
+
+
+def asterism_cost(n: int, asterism: int = 4) -> dict:
+    """
+    Estimates the cost of :func:`asterism_hashes` for `n` coordinates.
+
+    Parameters
+    ----------
+    n : int
+        Number of coordinates.
+    asterism : int, optional
+        The asterism to use for hashing, either 3, 4 or 5, by default 4.
+
+    Returns
+    -------
+    dict
+        ``count`` (number of asterisms considered), ``memory`` (peak memory in
+        bytes) and ``duration`` (rough duration in seconds).
+    """
+    if asterism == 3:
+        return cost3(n)
+    elif asterism == 4:
+        return cost4(n)
+    elif asterism == 5:
+        return cost5(n)
+    else:
+        raise ValueError("available asterisms are 3, 4 and 5")
+
+
+class HashGrid:
+    """
+    Lookup table of hashes quantized into integer bins of size `width`.
+
+    The bins of the hashes are encoded as integer keys stored in a sorted array, so
+    that the hashes close to a query are found by binary search of the query bin
+    and its neighbouring bins. Compared to a KD-tree, it is cheaper to build and
+    only made of arrays, so that it can be saved and shared.
+
+    Parameters
+    ----------
+    hashes : np.ndarray
+        The hashes, shape (n, d).
+    width : float
+        The size of the bins. Queries are the fastest for a tolerance below `width`.
+
+    Raises
+    ------
+    ValueError
+        If the grid has more than 2**63 bins, its keys not fitting in int64.
+    """
+
+    def __init__(self, hashes: np.ndarray, width: float):
+        self.hashes = hashes
+        self.width = float(width)
+        bins = np.floor(hashes / self.width)
+        # bins are encoded as int64 keys, which must hold all the grid bins
+        if not np.prod(bins.max(0) - bins.min(0) + 1) < 2**63:
+            raise ValueError(
+                f"HashGrid of width={self.width} has too many bins in "
+                f"{hashes.shape[1]} dimensions to be encoded, use a larger width "
+                "or a KD-tree"
+            )
+        bins = bins.astype(np.int64)
+        self.lower = bins.min(0)
+        self.shape = bins.max(0) - self.lower + 1
+        keys = self._keys(bins - self.lower)
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        self._occupied = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _strides(self):
+        return np.cumprod(np.r_[1, self.shape[:-1]])
+
+    def _keys(self, bins):
+        return bins @ self._strides()
+
+    def _occupied_prefixes(self):
+        # sorted keys of the occupied bins restricted to their first l dimensions,
+        # for l = 1 ... d (a key modulo the stride of dimension l only depends on
+        # the previous dimensions)
+        if self._occupied is None:
+            strides = self._strides()
+            self._occupied = [np.unique(self.keys % stride) for stride in strides[1:]]
+            self._occupied.append(np.unique(self.keys))
+        return self._occupied
+
+    def _probe_bytes(self, r: float) -> int:
+        # upper bound of the memory taken by the probed bins of a query hash
+        k = int(np.ceil(r / self.width))
+        return (2 * k + 1) ** len(self.shape) * len(self.shape) * 8
+
+    def query(self, hashes: np.ndarray, r: float):
+        """
+        Finds the pairs of `hashes` and grid hashes closer than `r`.
+
+        The bins neighbouring the query hashes bins are probed one dimension at a
+        time, only keeping the ones whose first dimensions match occupied bins, so
+        that the number of probes stays small in high dimensions. Queries are the
+        fastest for `r` below the grid `width`.
+
+        Parameters
+        ----------
+        hashes : np.ndarray
+            The query hashes, shape (m, d).
+        r : float
+            The maximum euclidean distance between two matched hashes.
+
+        Returns
+        -------
+        i : np.ndarray
+            Indices of the pairs hashes in `hashes`.
+        j : np.ndarray
+            Indices of the pairs hashes in the grid.
+        distances : np.ndarray
+            Euclidean distances between the pairs hashes.
+        """
+        k = int(np.ceil(r / self.width))
+        if k > 1:
+            warnings.warn(
+                f"HashGrid queried with r={r} larger than its width={self.width}, "
+                "probing many bins per hash"
+            )
+        offsets = np.arange(-k, k + 1)
+        bins = np.floor(hashes / self.width).astype(np.int64) - self.lower
+        strides = self._strides()
+
+        i = np.arange(len(hashes))
+        keys = np.zeros(len(hashes), dtype=np.int64)
+        for axis, occupied in enumerate(self._occupied_prefixes()):
+            probes = bins[i, axis][:, None] + offsets
+            inside = (probes >= 0) & (probes < self.shape[axis])
+            i = np.broadcast_to(i[:, None], probes.shape)[inside]
+            keys = (keys[:, None] + probes * strides[axis])[inside]
+            found = np.minimum(np.searchsorted(occupied, keys), len(occupied) - 1)
+            found = occupied[found] == keys
+            i, keys = i[found], keys[found]
+
+        left = np.searchsorted(self.keys, keys, side="left")
+        counts = np.searchsorted(self.keys, keys, side="right") - left
+        i = np.repeat(i, counts)
+        positions = np.repeat(left - np.cumsum(counts) + counts, counts)
+        j = self.order[positions + np.arange(len(positions))]
+
+        distances = np.linalg.norm(hashes[i] - self.hashes[j], axis=1)
+        close = distances <= r
+        i, j, distances = i[close], j[close], distances[close]
+        order = np.lexsort((j, i))
+        return i[order], j[order], distances[order]
+
+    def save(self, path: Union[str, Path]):
+        """Saves the grid in a npz file."""
+        np.savez(path, width=self.width, **self.arrays())
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "HashGrid":
+        """Loads a grid saved with :meth:`save`."""
+        with np.load(path) as f:
+            return cls.from_arrays(**f)
+
+    @classmethod
+    def from_arrays(cls, hashes, width, lower, shape, keys, order) -> "HashGrid":
+        """Creates a grid from its arrays, without copying them."""
+        grid = cls.__new__(cls)
+        grid.hashes = hashes
+        grid.width = float(width)
+        grid.lower = lower
+        grid.shape = shape
+        grid.keys = keys
+        grid.order = order
+        grid._occupied = None
+        return grid
+
+    def arrays(self) -> dict:
+        """The arrays of the grid, as taken by :meth:`from_arrays`."""
+        return dict(
+            hashes=self.hashes,
+            lower=self.lower,
+            shape=self.shape,
+            keys=self.keys,
+            order=self.order,
+        )
+
+
+class AsterismIndex(NamedTuple):
+    """
+    Asterisms hashes of a set of coordinates, with the lookup structure used to
+    query them (a :class:`scipy.spatial.cKDTree` or a :class:`HashGrid`).
+
+    An index can be built once for a catalog with :func:`build_index` and reused
+    across calls to :func:`twirl.match.find_transform`.
+    """
+
+    coords: np.ndarray
+    hashes: np.ndarray
+    asterisms: np.ndarray
+    members: np.ndarray
+    asterism: int
+    lookup: Union[cKDTree, HashGrid]
+
+
+def build_index(
+    coords: np.ndarray,
+    asterism: int = 4,
+    uniform: Optional[int] = None,
+    grid: Optional[float] = None,
+) -> AsterismIndex:
+    """
+    Builds the asterisms index of a set of coordinates.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Coordinates of the points, shape (n, 2).
+    asterism : int, optional
+        The asterism to use for hashing, either 3, 4 or 5, by default 4.
+    uniform : int, optional
+        If given, the asterisms are only built from `uniform` coordinates spread
+        over the field (see :func:`twirl.geometry.uniformize`), by default None.
+    grid : float, optional
+        If given, the hashes are stored in a :class:`HashGrid` with bins of size
+        `grid` (ideally the tolerance of the queries), instead of a KD-tree.
+        By default None.
+
+    Returns
+    -------
+    AsterismIndex
+        The index of the coordinates asterisms.
+    """
+    if uniform is None:
+        hashes, asterisms, members = asterism_hashes(coords, asterism)
+    else:
+        selected_coords, selected = uniformize(coords, uniform, return_indices=True)
+        hashes, asterisms, members = asterism_hashes(selected_coords, asterism)
+        # members index the stored coords
+        members = selected[members]
+    lookup = cKDTree(hashes) if grid is None else HashGrid(hashes, grid)
+    return AsterismIndex(coords, hashes, asterisms, members, asterism, lookup)
+
+
+# arrays of a HashGrid lookup stored with the index arrays, on top of its hashes
+_GRID_ARRAYS = ("lower", "shape", "keys", "order")
+
+
+def _index_arrays(index: AsterismIndex):
+    # the arrays of an index, including the ones of its lookup if it is a HashGrid
+    # (a KD-tree being rebuilt from the hashes when loaded)
+    arrays = dict(
+        coords=index.coords,
+        hashes=index.hashes,
+        asterisms=index.asterisms,
+        members=index.members,
+    )
+    if isinstance(index.lookup, HashGrid):
+        grid = index.lookup.arrays()
+        arrays.update({f"grid_{name}": grid[name] for name in _GRID_ARRAYS})
+        width = index.lookup.width
+    else:
+        width = None
+    meta = dict(asterism=int(index.asterism), width=width)
+    return arrays, meta
+
+
+def _from_arrays(arrays, meta) -> AsterismIndex:
+    # building a KD-tree is cheap compared to hashing the asterisms
+    hashes = arrays["hashes"]
+    if meta["width"] is None:
+        lookup = cKDTree(hashes)
+    elif "grid_keys" in arrays:
+        grid = {name: arrays[f"grid_{name}"] for name in _GRID_ARRAYS}
+        lookup = HashGrid.from_arrays(hashes, meta["width"], **grid)
+    else:
+        lookup = HashGrid(hashes, meta["width"])
+    return AsterismIndex(
+        arrays["coords"],
+        hashes,
+        arrays["asterisms"],
+        arrays["members"],
+        meta["asterism"],
+        lookup,
+    )
+
+
+def save_index(index: AsterismIndex, path: Union[str, Path]):
+    """
+    Saves an index in a directory, as one npy file per array, so that it can be
+    memory-mapped with :func:`load_index`.
+
+    The asterisms, their hashes and the arrays of a :class:`HashGrid` lookup are
+    saved, a KD-tree lookup being rebuilt from the hashes when loaded.
+
+    Parameters
+    ----------
+    index : AsterismIndex
+        The index to save.
+    path : str or Path
+        The directory in which the index is saved.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    arrays, meta = _index_arrays(index)
+    for name, array in arrays.items():
+        np.save(path / f"{name}.npy", array)
+    (path / "index.json").write_text(json.dumps(meta))
+
+
+def load_index(path: Union[str, Path], mmap_mode: Optional[str] = "r") -> AsterismIndex:
+    """
+    Loads an index saved with :func:`save_index`.
+
+    Parameters
+    ----------
+    path : str or Path
+        The directory in which the index was saved.
+    mmap_mode : str, optional
+        The memory-map mode of the arrays (see :func:`numpy.load`), by default "r"
+        so that processes loading the same index share its memory.
+
+    Returns
+    -------
+    AsterismIndex
+        The loaded index.
+    """
+    path = Path(path)
+    meta = json.loads((path / "index.json").read_text())
+    arrays = {
+        file.stem: np.load(file, mmap_mode=mmap_mode) for file in path.glob("*.npy")
+    }
+    return _from_arrays(arrays, meta)
+
+
+class SharedIndex:
+    """
+    An index published in shared memory, to be attached without copy by other
+    processes with :func:`attach_index`.
+
+    The asterisms, their hashes and the arrays of a :class:`HashGrid` lookup are
+    shared. A KD-tree lookup is rebuilt from the shared hashes, once per attaching
+    process. The shared memory is released when the publishing process calls
+    :meth:`close` (or exits the context manager).
+
+    Parameters
+    ----------
+    index : AsterismIndex
+        The index to publish.
+
+    Examples
+    --------
+    >>> with SharedIndex(index) as shared:
+    ...     pool.map(solve, [(shared.handle, pixels) for pixels in frames])
+
+    where the workers use ``find_transform(..., index=attach_index(handle))``.
+    """
+
+    def __init__(self, index: AsterismIndex):
+        arrays, meta = _index_arrays(index)
+        self._memory = []
+        handles = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=memory.buf)[...] = array
+            self._memory.append(memory)
+            handles[name] = (memory.name, array.shape, array.dtype.str)
+        self.handle = dict(meta, arrays=handles, tracker=_tracker_id())
+
+    def close(self):
+        """Releases the shared memory."""
+        for memory in self._memory:
+            memory.close()
+            memory.unlink()
+        self._memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# shared memory and indices attached by this process, kept for its lifetime
+_attached_memory = {}
+_attached_indices = {}
+
+
+def _tracker_id():
+    # identifies the resource tracker of this process, shared with its children,
+    # by the pipe used to talk to it (None if shared memory is not tracked)
+    if sys.version_info >= (3, 13) or os.name != "posix":
+        return None
+    stat = os.fstat(resource_tracker.getfd())
+    return (stat.st_dev, stat.st_ino)
+
+
+def _attach_memory(name, tracker):
+    if name not in _attached_memory:
+        if sys.version_info >= (3, 13):
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            memory = shared_memory.SharedMemory(name=name)
+            # only the publishing process is responsible for the shared memory. A
+            # process sharing its resource tracker (e.g. a multiprocessing child)
+            # must not unregister it, which would remove the publisher registration
+            if tracker is None or _tracker_id() != tuple(tracker):
+                resource_tracker.unregister(memory._name, "shared_memory")
+        _attached_memory[name] = memory
+    return _attached_memory[name]
+
+
+def attach_index(handle: dict) -> AsterismIndex:
+    """
+    Attaches an index published with :class:`SharedIndex`, without copying it.
+
+    The index is attached once per process, later calls with the same handle
+    returning the same index.
+
+    Parameters
+    ----------
+    handle : dict
+        The :attr:`SharedIndex.handle` of the published index.
+
+    Returns
+    -------
+    AsterismIndex
+        The index, whose arrays are views of the shared memory.
+    """
+    key = tuple(sorted(name for name, _, _ in handle["arrays"].values()))
+    if key not in _attached_indices:
+        arrays = {}
+        for name, (memory_name, shape, dtype) in handle["arrays"].items():
+            memory = _attach_memory(memory_name, handle.get("tracker"))
+            arrays[name] = np.ndarray(shape, np.dtype(dtype), buffer=memory.buf)
+            arrays[name].flags.writeable = False
+        _attached_indices[key] = _from_arrays(arrays, handle)
+    return _attached_indices[key]
@@ -1,11 +1,18 @@
-from typing import Optional
+import time
+import warnings
+from typing import Optional, Union
 
 import numpy as np
 from scipy.spatial import cKDTree
 
-from twirl.geometry import get_transform_matrix, pad
-from twirl.quads import hashes as hash4
-from twirl.triangles import hashes as hash3
+from twirl.geometry import get_transform_matrix, pad, uniformize
+from twirl.index import (
+    AsterismIndex,
+    HashGrid,
+    asterism_cost,
+    asterism_hashes,
+    build_index,
+)
 
 
 def count_cross_match(coords1, coords2, tol=1e-3):
@@ -62,6 +69,124 @@ def cross_match(coords1, coords2, tolerance=10):
     return np.array(matches)
 
 
+def candidate_pairs(
+    hashes: np.ndarray,
+    lookup: Union[cKDTree, HashGrid],
+    r: float,
+    max_memory: float = 2**28,
+    chunk_size: int = 64,
+):
+    """
+    Yields the pairs of hashes closer than `r`, chunk by chunk.
+
+    `hashes` are queried against `lookup` by blocks of rows, so that verification can
+    start on the first pairs found and the memory taken by the pairs stays bounded.
+
+    Parameters
+    ----------
+    hashes : np.ndarray
+        The query hashes, shape (n, d).
+    lookup : scipy.spatial.cKDTree or twirl.index.HashGrid
+        The lookup structure of the hashes to be matched.
+    r : float
+        The maximum euclidean distance between two matched hashes.
+    max_memory : float, optional
+        Approximate maximum memory (in bytes) taken by the pairs of a chunk and, for
+        a :class:`twirl.index.HashGrid`, by the bins probed to find them, by
+        default 256 MB.
+    chunk_size : int, optional
+        Number of query hashes in the first chunk, by default 64. The size of the
+        following chunks is adapted to the number of pairs found per hash.
+
+    Yields
+    ------
+    i : np.ndarray
+        Indices of the pairs hashes in `hashes`.
+    j : np.ndarray
+        Indices of the pairs hashes in `lookup`.
+    distances : np.ndarray
+        Euclidean distances between the pairs hashes.
+    """
+    # a pair takes 24 bytes in the output array and as much while being built
+    pair_bytes = 48
+    # bins probed by a HashGrid query hash, counted on top of its pairs
+    probe_bytes = lookup._probe_bytes(r) if isinstance(lookup, HashGrid) else 0
+    if probe_bytes > 0:
+        chunk_size = max(min(chunk_size, int(max_memory / probe_bytes)), 1)
+    start = 0
+    while start < len(hashes):
+        stop = min(start + chunk_size, len(hashes))
+        if isinstance(lookup, HashGrid):
+            i, j, distances = lookup.query(hashes[start:stop], r)
+        else:
+            pairs = cKDTree(hashes[start:stop]).sparse_distance_matrix(
+                lookup, r, output_type="ndarray"
+            )
+            pairs = pairs[np.lexsort((pairs["j"], pairs["i"]))]
+            i, j, distances = pairs["i"], pairs["j"], pairs["v"]
+        yield i + start, j, distances
+
+        pairs_per_row = max(len(i) / (stop - start), 1)
+        row_bytes = pair_bytes * pairs_per_row + probe_bytes
+        max_rows = max(int(max_memory / row_bytes), 1)
+        chunk_size = min(2 * chunk_size, max_rows)
+        start = stop
+
+
+def _brightness(members):
+    # mean rank of the asterisms stars, normalized from 0 (brightest) to 1
+    return np.mean(members, 1) / max(np.max(members, initial=0), 1)
+
+
+def _prior(members, size_rank):
+    # prior of the asterisms, lower is better: their size rank (hashes being sorted
+    # by decreasing A-B length) and the brightness of their stars, both from 0 to 1
+    return size_rank / max(len(members), 1) + _brightness(members)
+
+
+def _best_first(i, j, distances, r, prior_pixels, prior_radecs):
+    # candidates ranked by hash distance and by the priors of their asterisms
+    score = distances / r + prior_pixels[i] + prior_radecs[j]
+    order = np.argsort(score, kind="stable")
+    return i[order], j[order]
+
+
+# asterisms are not worth hashing from fewer stars, the next simpler asterism
+# being used instead
+MIN_STARS = 10
+
+
+def _max_stars(sizes, asterism, max_memory, max_duration):
+    # largest number of (brightest) stars n such that hashing min(n, size) stars
+    # of each set fits the budget
+    def fits(n):
+        costs = [asterism_cost(min(n, size), asterism) for size in sizes]
+        return sum(c["memory"] for c in costs) <= max_memory and (
+            max_duration is None or sum(c["duration"] for c in costs) <= max_duration
+        )
+
+    low, high = 0, max(sizes)
+    while low < high:
+        n = (low + high + 1) // 2
+        if fits(n):
+            low = n
+        else:
+            high = n - 1
+    return low
+
+
+def _fit_budget(sizes, asterism, max_memory, max_duration, simplify=True):
+    # number of stars hashed per set and asterism fitting the budget, the asterism
+    # being simplified if it could only be built from less than MIN_STARS stars.
+    # Budgets too small to hash MIN_STARS stars are not honoured
+    n_min = min(max(sizes), MIN_STARS)
+    for candidate in range(asterism, 2 if simplify else asterism - 1, -1):
+        n = _max_stars(sizes, candidate, max_memory, max_duration)
+        if n >= n_min:
+            return n, candidate
+    return n_min, asterism
+
+
 def find_transform(
     radecs: np.ndarray,
     pixels: np.ndarray,
@@ -69,6 +194,14 @@ def find_transform(
     asterism: int = 4,
     quads_tolerance: float = 0.02,
     tolerance: float = 12,
+    index: Optional[AsterismIndex] = None,
+    max_memory: float = 2**30,
+    uniform: Optional[int] = None,
+    hash_grid: bool = False,
+    best_first: bool = True,
+    time_budget: Optional[float] = None,
+    max_hypotheses: Optional[int] = None,
+    return_stats: bool = False,
 ) -> np.ndarray:
     """
     Finds the transformation matrix from `radecs` to `pixels`.
@@ -84,7 +217,10 @@ def find_transform(
         I.e., if the number of matched points is `>= min_match * len(pixels)`, the
         search stops and return the found transform. By default 0.7.
     asterism : int, optional
-        The asterism to use for hashing, either 3 or 4, by default 4.
+        The asterism to use for hashing, either 3, 4 or 5, by default 4. 5 points
+        asterisms are built from each point and its nearest neighbours (see
+        :func:`twirl.quints.hashes`). Their hashes being more discriminative, they
+        lead to fewer candidates to test in dense fields.
     quads_tolerance : float, optional
         The minimum euclidean distance between two quads to be matched and tested.
         By default 0.02.
@@ -93,47 +229,274 @@ def find_transform(
         (in `pixels` units). This serves to compute the number of coordinates being
         matched between `radecs` and `pixels` for a given transform.
         By default 12.
+    index : twirl.index.AsterismIndex, optional
+        A prebuilt index of the `radecs` asterisms (see
+        :func:`twirl.index.build_index`), to avoid hashing the same `radecs` on
+        every call. If provided, `radecs` must be the coordinates it was built
+        from and `asterism` is taken from it. By default None.
+    max_memory : float, optional
+        Approximate maximum memory (in bytes) taken by the hashing of the asterisms
+        and, once hashed, by the candidate pairs of asterisms at once. If hashing
+        all the coordinates would exceed it (see :func:`twirl.index.asterism_cost`),
+        only the brightest ones are hashed, and the next simpler asterism is used if
+        the asterism could only be built from less than 10 coordinates. Candidates are
+        generated and tested chunk by chunk, so that the search can stop before all
+        of them are generated. By default 1 GB.
+    uniform : int, optional
+        If given, the `pixels` asterisms are only built from `uniform` coordinates,
+        selected round-robin over a grid so that they are spread over the field
+        (see :func:`twirl.geometry.uniformize`). The coordinates must be sorted by
+        decreasing brightness. As the `radecs` usually cover a larger area than
+        the image, their grid would not line up with the image one, so they are
+        hashed from the brightest ones as usual. All coordinates are still used to
+        test the candidate transforms. By default None.
+    hash_grid : bool, optional
+        Whether to look up the `radecs` hashes in a :class:`twirl.index.HashGrid`
+        with bins of size `quads_tolerance` rather than in a KD-tree. The grid is
+        faster to build, which pays off for large `radecs`. Ignored if `index` is
+        provided. By default False.
+    best_first : bool, optional
+        Whether to test the candidate pairs of asterisms from the most to the least
+        promising, ranked by hash distance, asterism size and brightness of their
+        stars (`radecs` and `pixels` being sorted by decreasing brightness). The
+        ranking is exact within a chunk of candidates, chunks being generated from
+        the most promising `pixels` asterisms first. By default True.
+    time_budget : float, optional
+        Maximum duration of the search in seconds. Once reached, the search stops
+        and the best transform found so far is returned. The number of coordinates
+        hashed is limited, as for `max_memory`, so that hashing is estimated to take
+        at most half of it. By default None.
+    max_hypotheses : int, optional
+        Maximum number of candidate transforms tested. Once reached, the search
+        stops and the best transform found so far is returned. By default None.
+    return_stats : bool, optional
+        Whether to also return the statistics of the search, by default False.
 
     Returns
     -------
     np.ndarray
         The transformation matrix from `radecs` to `pixels`.
+    dict
+        Only if `return_stats` is True, the statistics of the search:
+        ``match_fraction`` (fraction of `pixels` matched by the returned
+        transform), ``hypotheses`` (number of transforms tested), ``exhaustive``
+        (False if the search was stopped by `time_budget` or `max_hypotheses`, or
+        the coordinates hashed were reduced to fit the budget, and `min_match` was
+        not reached), ``elapsed`` (duration of the search in seconds),
+        ``asterism`` (the asterism used), ``n_stars`` (maximum number of
+        coordinates hashed per set), ``capped`` (whether `n_stars` or
+        `asterism` were reduced to fit the budget) and ``flipped`` (whether the
+        returned transform mirrors `radecs`).
+
+    Notes
+    -----
+    The asterisms hashes are invariant to mirroring and the transforms are
+    affine, so that mirrored fields (e.g. from Newtonian telescopes or diagonals)
+    are solved in the same pass and at the same cost as direct ones.
     """
+    start = time.perf_counter()
+
+    if index is not None:
+        asterism = index.asterism
+
+    # number of coordinates hashed in each set, the radecs being already hashed
+    # if an index is provided
+    sizes = [len(pixels) if uniform is None else min(uniform, len(pixels))]
+    if index is None:
+        sizes.append(len(radecs))
+    n_stars, budget_asterism = _fit_budget(
+        sizes,
+        asterism,
+        max_memory,
+        None if time_budget is None else time_budget / 2,
+        simplify=index is None,
+    )
+    capped = n_stars < max(sizes) or budget_asterism != asterism
+    if capped:
+        warnings.warn(
+            f"asterisms hashed from the {n_stars} brightest coordinates only "
+            f"(asterism={budget_asterism}) to fit the memory and time budget"
+        )
 
-    if asterism == 3:
-        asterism_function = hash3
-    elif asterism == 4:
-        asterism_function = hash4
+    if index is None:
+        index = build_index(
+            radecs[0:n_stars],
+            budget_asterism,
+            grid=quads_tolerance if hash_grid else None,
+        )
+
+    if uniform is None:
+        selected = np.arange(min(n_stars, len(pixels)))
     else:
-        raise ValueError("available asterisms are 3 and 4")
+        _, selected = uniformize(pixels, min(uniform, n_stars), return_indices=True)
+    hashes_pixels, asterism_pixels, members_pixels = asterism_hashes(
+        pixels[selected], index.asterism
+    )
+    # members index the pixels, sorted by brightness
+    members_pixels = selected[members_pixels]
+    asterism_radecs = index.asterisms
 
-    hashes_pixels, asterism_pixels = asterism_function(pixels)
-    hashes_radecs, asterism_radecs = asterism_function(radecs)
+    if best_first:
+        # chunks of candidates are generated from the brightest pixels asterisms
+        # first, the largest first among equally bright ones
+        order = np.argsort(_brightness(members_pixels), kind="stable")
+        hashes_pixels = hashes_pixels[order]
+        asterism_pixels = asterism_pixels[order]
+        members_pixels = members_pixels[order]
+        # the pixels hashes were sorted by decreasing A-B length before
+        prior_pixels = _prior(members_pixels, order)
+        prior_radecs = _prior(index.members, np.arange(len(index.members)))
 
-    tree_pixels = cKDTree(hashes_pixels)
-    tree_radecs = cKDTree(hashes_radecs)
-    pairs = []
+    def candidates():
+        for ii, jj, distances in candidate_pairs(
+            hashes_pixels, index.lookup, quads_tolerance, max_memory=max_memory
+        ):
+            if best_first:
+                ii, jj = _best_first(
+                    ii, jj, distances, quads_tolerance, prior_pixels, prior_radecs
+                )
+            yield from zip(ii, jj)
 
-    ball_query = tree_pixels.query_ball_tree(tree_radecs, r=quads_tolerance)
-    matches = []
+    padded_radecs = pad(radecs)
+    best = None
+    best_match = 0
+    hypotheses = 0
+    # candidates from the coordinates left out of the hashing are never tested
+    exhaustive = not capped
 
-    for i, j in enumerate(ball_query):
-        if len(j) > 0:
-            pairs += [[i, k] for k in j]
+    for i, j in candidates():
+        if (max_hypotheses is not None and hypotheses >= max_hypotheses) or (
+            time_budget is not None and time.perf_counter() - start >= time_budget
+        ):
+            exhaustive = False
+            break
 
-    for i, j in pairs:
+        hypotheses += 1
         M = get_transform_matrix(asterism_radecs[j], asterism_pixels[i])
-        test = (M @ pad(radecs).T)[0:2].T
+        test = (M @ padded_radecs.T)[0:2].T
         match = count_cross_match(pixels, test, tolerance)
-        matches.append(match)
+        if best is None or match > best_match:
+            best, best_match = M, match
 
         if min_match is not None:
             if match >= min_match * len(pixels):
+                exhaustive = True
                 break
 
-    if len(matches) == 0:
-        return None
+    if return_stats:
+        return best, dict(
+            match_fraction=best_match / len(pixels),
+            hypotheses=hypotheses,
+            exhaustive=exhaustive,
+            elapsed=time.perf_counter() - start,
+            asterism=index.asterism,
+            n_stars=n_stars,
+            capped=capped,
+            flipped=best is not None and bool(np.linalg.det(best[0:2, 0:2]) < 0),
+        )
     else:
-        i, j = pairs[np.argmax(matches)]
-        M = get_transform_matrix(asterism_radecs[j], asterism_pixels[i])
-        return M
+        return best
+
+
+def refine_transform(
+    M: np.ndarray,
+    radecs: np.ndarray,
+    pixels: np.ndarray,
+    tolerance: float = 10,
+    min_tolerance: Optional[float] = None,
+    clip: float = 3.0,
+    max_iterations: int = 10,
+):
+    """
+    Iteratively refines the transformation matrix from `radecs` to `pixels`.
+
+    At each round, the transformed `radecs` are cross-matched to `pixels` within
+    a tolerance, outliers are sigma-clipped and the transform is fitted on the
+    remaining matches. The tolerance is then tightened to `clip` times the
+    residuals RMS. The refinement stops once the matched set and the residuals RMS
+    stop changing.
+
+    Parameters
+    ----------
+    M : np.ndarray
+        The initial transformation matrix from `radecs` to `pixels`, shape (3, 3).
+    radecs : np.ndarray
+        The coordinates to be transformed, shape (n, 2).
+    pixels : np.ndarray
+        The target coordinates, shape (m, 2).
+    tolerance : float, optional
+        The initial cross-match tolerance (in `pixels` units), by default 10.
+    min_tolerance : float, optional
+        The tolerance is never tightened below this value, by default
+        `tolerance / 10`.
+    clip : float, optional
+        Matches with residuals larger than `clip` times the residuals RMS are
+        rejected, by default 3.
+    max_iterations : int, optional
+        The maximum number of rounds, by default 10.
+
+    Returns
+    -------
+    M : np.ndarray
+        The refined transformation matrix, or None if less than 3 coordinates
+        could be matched.
+    matches : np.ndarray
+        Array of matched indices, where each row contains the indices of the
+        matched points in `pixels` and `radecs`.
+    stats : dict
+        Residuals statistics of the refined transform: ``rms`` (residuals RMS),
+        ``n_matches``, ``iterations`` and ``converged``.
+    """
+    if min_tolerance is None:
+        min_tolerance = tolerance / 10
+
+    tree = cKDTree(pixels)
+    padded_radecs = pad(radecs)
+    matches = np.zeros((0, 2), dtype=int)
+    previous = None
+    rms = np.inf
+    converged = False
+
+    for iteration in range(1, max_iterations + 1):
+        radecs_xy = (M @ padded_radecs.T)[0:2].T
+        distances, i = tree.query(radecs_xy, distance_upper_bound=tolerance)
+        (j,) = np.nonzero(np.isfinite(distances))
+        # a single (closest) radec per pixel
+        order = np.argsort(distances[j])
+        _, first = np.unique(i[j][order], return_index=True)
+        j = j[order][first]
+        i, distances = i[j], distances[j]
+
+        if len(j) > 0:
+            keep = distances <= clip * np.sqrt(np.mean(distances**2))
+            i, j = i[keep], j[keep]
+        if len(i) < 3:
+            return (
+                None,
+                matches,
+                dict(rms=rms, n_matches=len(i), iterations=iteration, converged=False),
+            )
+
+        M = get_transform_matrix(radecs[j], pixels[i])
+        residuals = np.linalg.norm((M @ pad(radecs[j]).T)[0:2].T - pixels[i], axis=1)
+        previous_rms, rms = rms, np.sqrt(np.mean(residuals**2))
+        matches = np.array([i, j]).T
+        matched = set(zip(i.tolist(), j.tolist()))
+
+        if matched == previous and np.isclose(rms, previous_rms, rtol=1e-3):
+            converged = True
+            break
+
+        previous = matched
+        tolerance = max(min(tolerance, clip * rms), min_tolerance)
+
+    return (
+        M,
+        matches,
+        dict(
+            rms=rms,
+            n_matches=len(matches),
+            iterations=iteration,
+            converged=converged,
+        ),
+    )
@@ -1,11 +1,12 @@
 from itertools import combinations
+from math import comb
 
 import numpy as np
 
 from twirl.geometry import proj, u1u2
 
 
-def reorder(quads):
+def reorder(quads, return_indices=False):
     distances = np.linalg.norm(
         quads[:, :, :, None] - np.rollaxis(quads.T, 2)[:, None, :, :], axis=2
     )
@@ -13,7 +14,11 @@ def reorder(quads):
     idxs = np.roll(
         np.argsort(distances[range(len(quads)), i], axis=1)[:, ::-1], 1, axis=1
     )
-    return np.array([q[i] for q, i in zip(quads, idxs)])
+    ordered_quads = np.take_along_axis(quads, idxs[:, :, None], axis=1)
+    if return_indices:
+        return ordered_quads, idxs
+    else:
+        return ordered_quads
 
 
 def good_quads(quads, circletol=0.01):
@@ -51,6 +56,8 @@ def quad_hash(quads, oriented=True):
     def cross2d(x, y):
         return x[..., 0] * y[..., 1] - x[..., 1] * y[..., 0]
 
+    # mirroring a quad reverses its orientation and swaps the projections of c and
+    # d on u1 and u2, so that swapping them back makes the hash parity-invariant
     if oriented:
         reverse = cross2d((b - a), (b - c)) >= 0
         # invert u1 and u2 for reversed quads
@@ -83,13 +90,47 @@ def clean_quads(xy):
     return ordered_quads[good_quads(ordered_quads)]
 
 
-def hashes(xy):
+def hashes(xy, return_indices=False):
     assert xy.shape[1] == 2
     quads_idxs = np.array(list(combinations(np.arange(xy.shape[0]), 4)))
     quads = xy[quads_idxs]
-    ordered_quads = reorder(quads)
-    good_ordered_quads = ordered_quads[good_quads(ordered_quads)]
+    ordered_quads, order = reorder(quads, return_indices=True)
+    good = good_quads(ordered_quads)
+    good_ordered_quads = ordered_quads[good]
     h, u = quad_hash(good_ordered_quads)
     # we sort hashes from larger AB (see Lang 2008)
-    idxs = np.argsort(np.linalg.norm(u[:, 1] - u[:, 0], axis=1))
-    return h[idxs[::-1]], good_ordered_quads[idxs[::-1]]
+    idxs = np.argsort(np.linalg.norm(u[:, 1] - u[:, 0], axis=1))[::-1]
+    if return_indices:
+        members = np.take_along_axis(quads_idxs, order, axis=1)[good]
+        return h[idxs], good_ordered_quads[idxs], members[idxs]
+    else:
+        return h[idxs], good_ordered_quads[idxs]
+
+
+# peak bytes allocated per quad by :func:`hashes`: the list of combinations (a
+# pointer and a 4-tuple), the (n, 4) indices, the (n, 4, 2) quads and, in
+# `reorder`, the (n, 4, 2, 4) differences, their squares and the (n, 4, 4)
+# distances, plus the smaller temporaries
+QUAD_BYTES = 900
+# seconds per quad, measured on a laptop CPU
+QUAD_DURATION = 1e-5
+
+
+def cost(n):
+    """
+    Estimates the cost of :func:`hashes` for `n` points, before allocating anything.
+
+    Parameters
+    ----------
+    n : int
+        Number of points.
+
+    Returns
+    -------
+    dict
+        ``count`` (number of quads considered, i.e. before filtering),
+        ``memory`` (peak memory in bytes) and ``duration`` (rough duration in
+        seconds, that depends on the machine).
+    """
+    count = comb(n, 4)
+    return dict(count=count, memory=count * QUAD_BYTES, duration=count * QUAD_DURATION)
@@ -1,12 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Optional, Tuple, Union
 
 import astropy.units as u
 import numpy as np
 from astropy.coordinates import SkyCoord
+from astropy.table import unique, vstack
 from astropy.units import Quantity
 
 
+def _ra_ranges(ra_min, ra_max):
+    """RA ranges covering [ra_min, ra_max), split where they cross RA=0/360"""
+    if ra_max - ra_min >= 360:
+        return [(0.0, 360.0)]
+    ra_min, ra_max = ra_min % 360, ra_max % 360
+    if ra_min < ra_max:
+        return [(ra_min, ra_max)]
+    return [(ra_min, 360.0), (0.0, ra_max)] if ra_max > 0 else [(ra_min, 360.0)]
+
+
+def _tiles(ra, dec, ra_fov, dec_fov, n):
+    """RA-DEC bounds (ra_min, ra_max, dec_min, dec_max) of the n x n tiles of a field
+
+    The FOV is given in degrees on the sky, so that its extent in RA grows as
+    1/cos(dec) (up to the full circle near the poles). Tiles crossing RA=0/360 are
+    split in two.
+    """
+    dec_min, dec_max = max(dec - dec_fov / 2, -90.0), min(dec + dec_fov / 2, 90.0)
+    # RA extent at the edge of the field farthest from the equator
+    cos_dec = np.cos(np.deg2rad(max(abs(dec_min), abs(dec_max))))
+    if cos_dec * 180 <= ra_fov / 2:
+        ra_edges = np.linspace(0, 360, n + 1)
+    else:
+        half_width = ra_fov / 2 / cos_dec
+        ra_edges = np.linspace(ra - half_width, ra + half_width, n + 1)
+    dec_edges = np.linspace(dec_min, dec_max, n + 1)
+    return [
+        (ra_range[0], ra_range[1], dec_edges[j], dec_edges[j + 1])
+        for j in range(n)
+        for i in range(n)
+        for ra_range in _ra_ranges(ra_edges[i], ra_edges[i + 1])
+    ]
+
+
+def _circle_fractions(bounds, ra, dec, radius, samples=16):
+    """Approximate fraction of the sky area of each tile within `radius` of (ra, dec)
+
+    Estimated on a `samples` x `samples` grid of points per tile, weighted by
+    cos(dec).
+    """
+    center = SkyCoord(ra, dec, unit="deg")
+    steps = (np.arange(samples) + 0.5) / samples
+    fractions = []
+    for ra_min, ra_max, dec_min, dec_max in bounds:
+        ras, decs = np.meshgrid(
+            ra_min + steps * (ra_max - ra_min), dec_min + steps * (dec_max - dec_min)
+        )
+        inside = SkyCoord(ras, decs, unit="deg").separation(center).deg <= radius
+        weights = np.cos(np.deg2rad(decs))
+        fractions.append(np.sum(weights * inside) / np.sum(weights))
+    return np.array(fractions)
+
+
+def _tiled_query(bounds, tile_limit, tmass):
+    """Concurrently query the Gaia sources of each tile, merged and sorted by magnitude"""
+    from astroquery.gaia import Gaia
+
+    fields = (
+        "gaia.source_id, gaia.ra, gaia.dec, gaia.pmra, gaia.pmdec, "
+        "gaia.phot_g_mean_mag"
+    )
+
+    if tmass:
+        fields += ", tmass.j_m"
+        join = """
+            INNER JOIN gaiadr2.tmass_best_neighbour AS tmass_match ON tmass_match.source_id = gaia.source_id
+            INNER JOIN gaiadr1.tmass_original_valid AS tmass ON tmass.tmass_oid = tmass_match.tmass_oid"""
+        order = "tmass.j_m"
+        column = "j_m"
+    else:
+        join = ""
+        order = "gaia.phot_g_mean_mag"
+        column = "phot_g_mean_mag"
+
+    def query(bounds):
+        ra_min, ra_max, dec_min, dec_max = bounds
+        job = Gaia.launch_job(
+            f"""
+            SELECT top {tile_limit} {fields}
+            FROM gaiadr2.gaia_source AS gaia{join}
+            WHERE gaia.ra >= {ra_min} AND gaia.ra < {ra_max} AND
+            gaia.dec >= {dec_min} AND gaia.dec < {dec_max}
+            ORDER BY {order}
+            """
+        )
+        return job.get_results()
+
+    with ThreadPoolExecutor(max_workers=min(len(bounds), 16)) as pool:
+        tables = list(pool.map(query, bounds))
+
+    table = unique(vstack(tables), keys="source_id")
+    table.sort(column)
+    return table
+
+
 def gaia_radecs(
     center: Union[Tuple[float, float], SkyCoord],
     fov: Union[float, Quantity],
@@ -15,6 +112,8 @@ def gaia_radecs(
     tmass: bool = False,
     dateobs: Optional[datetime] = None,
     magnitude: bool = False,
+    tiles: Optional[int] = None,
+    tile_limit: Optional[int] = None,
 ) -> np.ndarray:
     """
     Query the Gaia archive to retrieve the RA-DEC coordinates of stars within a given field-of-view (FOV) centered on a given sky position.
@@ -33,6 +132,15 @@ def gaia_radecs(
         Whether to retrieve the 2MASS J magnitudes catelog. By default, it is set to False.
     dateobs : datetime.datetime, optional
         The date of the observation. If given, the proper motions of the sources will be taken into account. By default, it is set to None.
+    magnitude : bool, optional
+        Whether to also return the Gaia G magnitudes of the sources. By default, it is set to False.
+    tiles : int, optional
+        If given, wide-field mode: the FOV is split into `tiles` x `tiles` sub-tiles queried concurrently, each returning its
+        `tile_limit` brightest sources. This is faster than a single query for wide fields and gives a uniform coverage of the FOV.
+        By default, it is set to None (single query).
+    tile_limit : int, optional
+        The maximum number of sources retrieved per tile in wide-field mode. By default, `limit` divided by the number of tiles (rounded up),
+        only counting the part of the tiles within the circle if `circular` is True. Tiles entirely outside the circle are not queried.
 
     Returns
     -------
@@ -70,6 +178,26 @@ def gaia_radecs(
 
     radius = np.min([ra_fov, dec_fov]) / 2
 
+    if tiles is not None:
+        bounds = _tiles(ra, dec, ra_fov, dec_fov, tiles)
+        # number of tiles worth of area returned, each tile giving `tile_limit` sources
+        area = tiles**2
+        if circular:
+            fractions = _circle_fractions(bounds, ra, dec, radius)
+            # tiles entirely outside the circle are not queried
+            bounds = [b for b, fraction in zip(bounds, fractions) if fraction > 0]
+            area = np.sum(fractions)
+        if tile_limit is None:
+            tile_limit = int(np.ceil(limit / area))
+        table = _tiled_query(bounds, tile_limit, tmass)
+        if circular:
+            separation = SkyCoord(table["ra"], table["dec"], unit="deg").separation(
+                SkyCoord(ra, dec, unit="deg")
+            )
+            table = table[separation.deg <= radius]
+        table = table[0:limit]
+        return _table_radecs(table, dateobs, magnitude)
+
     fields = f"gaia.ra, gaia.dec, gaia.pmra, gaia.pmdec {',gaia.phot_g_mean_mag' if magnitude else ''}"
 
     if circular and not tmass:
@@ -120,7 +248,10 @@ def gaia_radecs(
         )
 
     table = job.get_results()
+    return _table_radecs(table, dateobs, magnitude)
+
 
+def _table_radecs(table, dateobs, magnitude):
     # add proper motion to ra and dec
     if dateobs is not None:
         # calculate fractional year
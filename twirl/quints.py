@@ -0,0 +1,157 @@
+from itertools import combinations
+from math import comb
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from twirl.quads import good_quads, reorder
+
+
+def neighbourhoods(xy, k=8):
+    """
+    Indices of the asterisms of five points made of each point and four of its `k`
+    nearest neighbours.
+
+    Parameters
+    ----------
+    xy : ndarray
+        An array of shape (n_points, 2) representing the x and y coordinates of each point.
+    k : int, optional
+        The number of nearest neighbours of each point considered. Default is 8.
+
+    Returns
+    -------
+    ndarray
+        An array of shape (n_quints, 5) with the sorted indices of the points of each
+        asterism in xy, without duplicates.
+    """
+    k = min(k, len(xy) - 1)
+    if k < 4:
+        return np.zeros((0, 5), dtype=int)
+    # the first neighbour of each point is the point itself
+    _, neighbours = cKDTree(xy).query(xy, k + 1)
+    choices = np.array(list(combinations(range(1, k + 1), 4)))
+    centers = np.repeat(neighbours[:, 0], len(choices))
+    quints = np.hstack([centers[:, None], neighbours[:, choices].reshape(-1, 4)])
+    return np.unique(np.sort(quints, axis=1), axis=0)
+
+
+def quint_hash(quints):
+    """
+    Computes the hashes of ordered asterisms of five points.
+
+    The hash is made of the coordinates of the last three points in the frame where
+    the first two points A and B are at (0, 0) and (1, 0), as in
+    :func:`twirl.quads.quad_hash`. It is invariant to similarity transforms and to
+    mirroring.
+
+    Parameters
+    ----------
+    quints : ndarray
+        An array of shape (n_quints, 5, 2) with the points of each asterism, A and B
+        being the two most distant ones (see :func:`twirl.quads.reorder`).
+
+    Returns
+    -------
+    hashes : ndarray
+        An array of shape (n_quints, 6) with the hashes of the asterisms.
+    order : ndarray
+        An array of shape (n_quints, 5) with the indices ordering the points of each
+        asterism consistently with its hash.
+    """
+    a, b = quints[:, 0], quints[:, 1]
+    ab = b - a
+    norm = np.sum(ab**2, axis=1)[:, None]
+    others = quints[:, 2:] - a[:, None, :]
+    x = np.sum(others * ab[:, None, :], axis=2) / norm
+    y = (ab[:, None, 0] * others[..., 1] - ab[:, None, 1] * others[..., 0]) / norm
+
+    order = np.tile(np.arange(5), (len(quints), 1))
+    # A is the end of AB closest to the other points. Swapping A and B rotates the
+    # frame by 180 degrees
+    swap = np.mean(x, axis=1) > 0.5
+    x[swap], y[swap] = 1 - x[swap], -y[swap]
+    order[swap, 0:2] = [1, 0]
+    # mirrored asterisms have opposite y, the other points being mostly above AB
+    y[np.sum(y, axis=1) < 0] *= -1
+    # the other points ordered along AB
+    along = np.argsort(x, axis=1)
+    x = np.take_along_axis(x, along, axis=1)
+    y = np.take_along_axis(y, along, axis=1)
+    order[:, 2:] = along + 2
+
+    return np.stack([x, y], axis=2).reshape(-1, 6), order
+
+
+def hashes(xy, k=8, return_indices=False):
+    """
+    Computes the hashes of the asterisms of five points formed by each point and
+    four of its `k` nearest neighbours.
+
+    Parameters
+    ----------
+    xy : ndarray
+        An array of shape (n_points, 2) representing the x and y coordinates of each point.
+    k : int, optional
+        The number of nearest neighbours of each point considered. Default is 8.
+    return_indices : bool, optional
+        Whether to also return the indices of the asterisms points in xy. Default is False.
+
+    Returns
+    -------
+    hashes : ndarray
+        An array of shape (n_quints, 6) representing the hashes of the asterisms,
+        sorted by decreasing A-B length.
+    quints : ndarray
+        An array of shape (n_quints, 5, 2) representing the points of each asterism.
+    indices : ndarray
+        Only if `return_indices` is True, an array of shape (n_quints, 5) representing
+        the indices of the points of each asterism in xy.
+    """
+    assert xy.shape[1] == 2
+    quints_idxs = neighbourhoods(xy, k)
+    quints, order = reorder(xy[quints_idxs], return_indices=True)
+    good = good_quads(quints)
+    quints, order = quints[good], order[good]
+    h, canonical = quint_hash(quints)
+    quints = np.take_along_axis(quints, canonical[:, :, None], axis=1)
+    members = np.take_along_axis(
+        np.take_along_axis(quints_idxs[good], order, axis=1), canonical, axis=1
+    )
+    # we sort hashes from larger AB, as for quads
+    idxs = np.argsort(np.linalg.norm(quints[:, 1] - quints[:, 0], axis=1))[::-1]
+    if return_indices:
+        return h[idxs], quints[idxs], members[idxs]
+    else:
+        return h[idxs], quints[idxs]
+
+
+# peak bytes allocated per asterism by :func:`hashes`, mostly the (n, 5, 2, 5)
+# differences computed by `reorder`
+QUINT_BYTES = 1000
+# seconds per asterism, measured on a laptop CPU
+QUINT_DURATION = 6e-6
+
+
+def cost(n, k=8):
+    """
+    Estimates the cost of :func:`hashes` for `n` points, before allocating anything.
+
+    Parameters
+    ----------
+    n : int
+        The number of points.
+    k : int, optional
+        The number of nearest neighbours of each point considered. Default is 8.
+
+    Returns
+    -------
+    dict
+        ``count`` (maximum number of asterisms considered, i.e. before removing
+        duplicates and filtering), ``memory`` (peak memory in bytes) and
+        ``duration`` (rough duration in seconds, that depends on the machine).
+    """
+    count = n * comb(min(k, max(n - 1, 0)), 4)
+    return dict(
+        count=count, memory=count * QUINT_BYTES, duration=count * QUINT_DURATION
+    )
@@ -0,0 +1,210 @@
+from typing import Callable, Optional
+
+import numpy as np
+from astropy.wcs import WCS
+from scipy import fft
+from skimage.transform import rotate, warp_polar
+
+from twirl.utils import _bin_image
+
+
+def _subpixel_peak(surface, sinc=True):
+    # location of the correlation peak, refined along each axis from its
+    # neighbours assuming a sinc-shaped (Foroosh et al. 2002) or parabolic peak
+    peak = np.array(np.unravel_index(np.argmax(surface), surface.shape))
+    location = peak.astype(float)
+    top = surface[tuple(peak)]
+    for axis, n in enumerate(surface.shape):
+        before, after = peak.copy(), peak.copy()
+        before[axis] = (peak[axis] - 1) % n
+        after[axis] = (peak[axis] + 1) % n
+        y0, y2 = surface[tuple(before)], surface[tuple(after)]
+        if not sinc:
+            if y0 - 2 * top + y2 != 0:
+                location[axis] += 0.5 * (y0 - y2) / (y0 - 2 * top + y2)
+        elif y2 >= y0 and y2 > 0:
+            location[axis] += y2 / (y2 + top)
+        elif y0 > 0:
+            location[axis] -= y0 / (y0 + top)
+    # wrap to [-n/2, n/2)
+    shape = np.array(surface.shape)
+    return (location + shape / 2) % shape - shape / 2, top
+
+
+def phase_correlation(
+    spectrum: np.ndarray, reference: np.ndarray, shape: tuple, sinc: bool = True
+):
+    """
+    Phase correlation of two images given their real FFTs.
+
+    Parameters
+    ----------
+    spectrum : np.ndarray
+        The real FFT of the image.
+    reference : np.ndarray
+        The real FFT of the reference image.
+    shape : tuple
+        The shape of the images.
+    sinc : bool, optional
+        Whether the sub-pixel location of the correlation peak is estimated
+        assuming a sinc-shaped peak, as for the phase correlation of shifted
+        images, or a parabolic one. By default True.
+
+    Returns
+    -------
+    np.ndarray
+        The (y, x) shift of the image content with respect to the reference.
+    float
+        The peak-to-sidelobe ratio of the correlation, i.e. the height of its peak
+        above the mean in units of standard deviation.
+    """
+    cross_power = spectrum * np.conj(reference)
+    cross_power /= np.abs(cross_power) + 1e-12
+    surface = fft.irfft2(cross_power, s=shape)
+    location, peak = _subpixel_peak(surface, sinc=sinc)
+    return location, (peak - np.mean(surface)) / np.std(surface)
+
+
+class Tracker:
+    """
+    Tracks the WCS of an image sequence by FFT cross-correlation with a reference
+    frame, instead of detecting and matching stars in every frame.
+
+    The offset (and optionally the rotation) of each new frame with respect to
+    the reference frame is estimated by phase correlation on binned images and
+    applied to the reference WCS. When the correlation quality drops below
+    `min_quality`, the frame is fully solved with `solve` and becomes the new
+    reference.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The reference frame.
+    wcs : astropy.wcs.WCS
+        The WCS of the reference frame, e.g. from :func:`twirl.compute_wcs`.
+    solve : callable, optional
+        Function returning the WCS of a frame (or None), called when the
+        correlation quality is too low, e.g.
+        ``lambda data: compute_wcs(find_peaks(data)[0:12], radecs)``.
+        By default None (no re-solve, :meth:`update` returns None instead).
+    binning : int, optional
+        Binning of the frames before correlation, by default 4.
+    rotation : bool, optional
+        Whether to also estimate the rotation of the frames around their center,
+        by default False.
+    min_quality : float, optional
+        Minimum peak-to-sidelobe ratio of the phase correlation for the offset to
+        be trusted, by default 20. Unrelated star fields typically lead to ratios
+        below 15.
+    """
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        wcs: WCS,
+        solve: Optional[Callable[[np.ndarray], Optional[WCS]]] = None,
+        binning: int = 4,
+        rotation: bool = False,
+        min_quality: float = 20.0,
+    ):
+        self.solve = solve
+        self.binning = binning
+        self.rotation = rotation
+        self.min_quality = min_quality
+        self.offset = np.zeros(2)
+        self.angle = 0.0
+        self.quality = np.inf
+        self.solved = False
+        self.reset(data, wcs)
+
+    def _prepare(self, data):
+        binned = _bin_image(data, self.binning)
+        binned = np.nan_to_num(binned - np.nanmedian(binned))
+        if self._window is None or self._window.shape != binned.shape:
+            self._window = np.outer(*[np.hanning(n) for n in binned.shape])
+        return binned
+
+    def _polar(self, image):
+        # FFT of the (log-scaled) magnitude spectrum of the image resampled on a
+        # polar grid with a linear radius, where rotations become translations
+        # along the angle axis and translations have no effect
+        magnitude = fft.fftshift(np.abs(fft.fft2(image * self._window)))
+        return fft.rfft2(
+            warp_polar(np.log1p(magnitude), output_shape=(360, self._radius))
+        )
+
+    def reset(self, data: np.ndarray, wcs: WCS):
+        """Sets a new reference frame and its WCS."""
+        self._window = None
+        binned = self._prepare(data)
+        self.wcs = wcs
+        self.shape = data.shape
+        self._binned_shape = binned.shape
+        self._reference = fft.rfft2(binned * self._window)
+        if self.rotation:
+            self._radius = min(binned.shape) // 2
+            self._polar_reference = self._polar(binned)
+
+    def _estimate(self, data):
+        binned = self._prepare(data)
+        angle = 0.0
+        if self.rotation:
+            (shift, _), _ = phase_correlation(
+                self._polar(binned),
+                self._polar_reference,
+                (360, self._radius),
+                sinc=False,
+            )
+            angle = np.deg2rad(shift)
+            binned = rotate(binned, shift, mode="constant")
+        (dy, dx), quality = phase_correlation(
+            fft.rfft2(binned * self._window), self._reference, self._binned_shape
+        )
+        # the shift is measured in the derotated frame
+        c, s = np.cos(angle), np.sin(angle)
+        offset = np.array([[c, -s], [s, c]]) @ np.array([dx, dy]) * self.binning
+        return offset, angle, quality
+
+    def shifted_wcs(self, offset, angle: float = 0.0) -> WCS:
+        """
+        The reference WCS, for a frame whose content is shifted by `offset` (x, y)
+        pixels and rotated by `angle` radians around its center.
+        """
+        wcs = self.wcs.deepcopy()
+        c, s = np.cos(angle), np.sin(angle)
+        R = np.array([[c, -s], [s, c]])
+        # 1-based FITS coordinates of the frame center
+        center = (np.array(self.shape[::-1]) - 1) / 2 + 1
+        wcs.wcs.crpix = center + offset + R @ (wcs.wcs.crpix - center)
+        if wcs.wcs.has_cd():
+            wcs.wcs.cd = wcs.wcs.cd @ R.T
+        else:
+            wcs.wcs.pc = wcs.wcs.pc @ R.T
+        wcs.wcs.set()
+        return wcs
+
+    def update(self, data: np.ndarray) -> Optional[WCS]:
+        """
+        Returns the WCS of a new frame.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            The new frame, with the same shape as the reference frame.
+
+        Returns
+        -------
+        astropy.wcs.WCS
+            The WCS of the frame, or None if the correlation quality is below
+            `min_quality` and the frame could not be solved.
+        """
+        self.offset, self.angle, self.quality = self._estimate(data)
+        self.solved = False
+        if self.quality >= self.min_quality:
+            return self.shifted_wcs(self.offset, self.angle)
+
+        wcs = None if self.solve is None else self.solve(data)
+        if wcs is not None:
+            self.solved = True
+            self.reset(data, wcs)
+        return wcs
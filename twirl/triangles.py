@@ -1,11 +1,12 @@
 from itertools import combinations
+from math import comb
 
 import numpy as np
 
 from twirl.geometry import triangle_angles
 
 
-def order_points(triangles):
+def order_points(triangles, return_indices=False):
     """
     Orders the vertices of each triangle in a consistent manner.
 
@@ -15,11 +16,16 @@ def order_points(triangles):
     ----------
     triangles : ndarray
         An array of shape (n_triangles, 3, 2) representing the vertices of each triangle.
+    return_indices : bool, optional
+        Whether to also return the indices ordering the vertices. Default is False.
 
     Returns
     -------
     ndarray
         An array of shape (n_triangles, 3, 2) with the vertices of each triangle ordered consistently.
+    ndarray
+        Only if `return_indices` is True, an array of shape (n_triangles, 3) with the indices
+        ordering the vertices of each triangle.
     """
 
     # Compute the centroid of the triangles
@@ -34,10 +40,13 @@ def order_points(triangles):
     # Use numpy's advanced indexing to sort the triangles
     ordered_triangles = np.take_along_axis(triangles, sort_indices[:, :, None], axis=1)
 
-    return ordered_triangles
+    if return_indices:
+        return ordered_triangles, sort_indices
+    else:
+        return ordered_triangles
 
 
-def hashes(xy, min_angle=np.deg2rad(30)):
+def hashes(xy, min_angle=np.deg2rad(30), return_indices=False):
     """
     Computes the hashes of the triangles formed by the points in xy.
 
@@ -47,6 +56,8 @@ def hashes(xy, min_angle=np.deg2rad(30)):
         An array of shape (n_points, 2) representing the x and y coordinates of each point.
     min_angle : float, optional
         The minimum angle (in radians) that a triangle must have to be included in the hashes. Default is 30 degrees.
+    return_indices : bool, optional
+        Whether to also return the indices of the triangles vertices in xy. Default is False.
 
     Returns
     -------
@@ -54,15 +65,52 @@ def hashes(xy, min_angle=np.deg2rad(30)):
         An array of shape (n_hashes, 2) representing the hashes of the triangles.
     triangles : ndarray
         An array of shape (n_triangles, 3, 2) representing the vertices of each triangle.
+    indices : ndarray
+        Only if `return_indices` is True, an array of shape (n_triangles, 3) representing the
+        indices of the vertices of each triangle in xy.
     """
 
     triangles_idxs = np.array(list(combinations(np.arange(xy.shape[0]), 3)))
     triangles = xy[triangles_idxs]
-    triangles = order_points(triangles)
+    triangles, order = order_points(triangles, return_indices=True)
     angles = triangle_angles(triangles)
     # keep only triangles with any angle > min_angle
     mask = np.all(np.abs(angles) > min_angle, axis=1)
     triangles = triangles[mask]
     angles = angles[mask]
     hashes = np.sort(angles, axis=1)[:, 0:2]
-    return hashes, triangles
+    if return_indices:
+        indices = np.take_along_axis(triangles_idxs, order, axis=1)[mask]
+        return hashes, triangles, indices
+    else:
+        return hashes, triangles
+
+
+# peak bytes allocated per triangle by :func:`hashes`: the list of combinations
+# (a pointer and a 3-tuple), the (n, 3) indices, the (n, 3, 2) triangles and
+# their ordered copy, the distances to the centroids and the angles
+TRIANGLE_BYTES = 300
+# seconds per triangle, measured on a laptop CPU
+TRIANGLE_DURATION = 3.5e-6
+
+
+def cost(n):
+    """
+    Estimates the cost of :func:`hashes` for `n` points, before allocating anything.
+
+    Parameters
+    ----------
+    n : int
+        The number of points.
+
+    Returns
+    -------
+    dict
+        ``count`` (number of triangles considered, i.e. before filtering),
+        ``memory`` (peak memory in bytes) and ``duration`` (rough duration in
+        seconds, that depends on the machine).
+    """
+    count = comb(n, 3)
+    return dict(
+        count=count, memory=count * TRIANGLE_BYTES, duration=count * TRIANGLE_DURATION
+    )
@@ -1,3 +1,6 @@
+import time
+from typing import Optional
+
 import numpy as np
 from astropy import units as u
 from astropy.coordinates import SkyCoord
@@ -6,8 +9,15 @@ from astropy.wcs.utils import WCS, fit_wcs_from_points
 from scipy.ndimage import gaussian_filter
 from skimage.measure import label, regionprops
 
-from twirl.geometry import pad
-from twirl.match import cross_match, find_transform, get_transform_matrix
+from twirl.cache import SolutionCache
+from twirl.index import AsterismIndex, build_index
+from twirl.match import (
+    count_cross_match,
+    cross_match,
+    find_transform,
+    get_transform_matrix,
+    refine_transform,
+)
 from twirl.queries import gaia_radecs
 
 
@@ -22,6 +32,54 @@ def _project_tangent_plane(center, skycoords):
     return np.array([tangent_ra.deg, tangent_dec.deg])
 
 
+def catalog_index(
+    radecs: np.ndarray,
+    asterism: int = 4,
+    uniform: Optional[int] = None,
+    grid: Optional[float] = None,
+) -> AsterismIndex:
+    """
+    Build the asterisms index of some RA-DEC coordinates, to be reused across
+    calls to :func:`compute_wcs` with the same `radecs`.
+
+    Parameters
+    ----------
+    radecs : np.ndarray
+        RA-DEC coordinates, shape (m, 2)
+    asterism : int, optional
+        Number of sources to use for matching, by default 4
+    uniform : int, optional
+        Number of sources spread uniformly over the `radecs` footprint used to build
+        the asterisms (see :func:`twirl.geometry.uniformize`), only relevant if the
+        `radecs` cover the same area as the images. By default None (all sources).
+    grid : float, optional
+        If given, the hashes are looked up in a :class:`twirl.index.HashGrid` with
+        bins of size `grid` (ideally `quads_tolerance`), by default None (KD-tree).
+
+    Returns
+    -------
+    twirl.index.AsterismIndex
+        The index of the tangent plane projected `radecs` asterisms.
+    """
+    center = SkyCoord(*radecs.mean(0), unit="deg")
+    radecs = _project_tangent_plane(center, SkyCoord(radecs, unit="deg")).T
+    return build_index(radecs, asterism, uniform, grid)
+
+
+def _fit_wcs(pixel_coords, radecs, original_radecs, M, tolerance, max_iterations):
+    # refine the affine transform on cross-matched sources and fit the WCS
+    M, matches, stats = refine_transform(
+        M, radecs, pixel_coords, tolerance=tolerance, max_iterations=max_iterations
+    )
+    if M is None:
+        return None, stats
+    i, j = matches.T
+    wcs = fit_wcs_from_points(
+        pixel_coords[i].T, SkyCoord(original_radecs[j], unit="deg")
+    )
+    return wcs, stats
+
+
 def compute_wcs(
     pixel_coords: np.ndarray,
     radecs: np.ndarray,
@@ -29,6 +87,15 @@ def compute_wcs(
     quads_tolerance: float = 0.1,
     asterism=4,
     min_match=0.8,
+    cache: Optional[SolutionCache] = None,
+    index: Optional[AsterismIndex] = None,
+    max_memory: float = 2**30,
+    max_iterations: int = 10,
+    return_stats: bool = False,
+    uniform: Optional[int] = None,
+    hash_grid: bool = False,
+    time_budget: Optional[float] = None,
+    max_hypotheses: Optional[int] = None,
 ) -> WCS:
     """
     Compute the WCS solution for an image given pixel coordinates and some unordered RA-DEC values.
@@ -45,6 +112,42 @@ def compute_wcs(
         Number of sources to use for matching, by default 4
     min_match : int, optional
         Minimum number of matches required, by default None
+    cache : twirl.cache.SolutionCache, optional
+        Cache of previous solutions. A solution cached for the same pointing and
+        detections fingerprint is tried first and accepted if at least
+        `min_match` of the pixel coordinates are cross-matched within `tolerance`.
+        Otherwise, a full search is performed and its solution cached.
+        By default None (no cache).
+    index : twirl.index.AsterismIndex, optional
+        Index of the `radecs` asterisms built with :func:`catalog_index`, to avoid
+        hashing the same `radecs` on every call. By default None.
+    max_memory : float, optional
+        Approximate maximum memory (in bytes) taken by the hashing of the asterisms
+        and by their candidate pairs, see :func:`twirl.match.find_transform`. By
+        default 1 GB.
+    max_iterations : int, optional
+        Maximum number of rounds of the iterative refinement of the solution (see
+        :func:`twirl.match.refine_transform`), starting with a cross-match
+        tolerance of `2 * tolerance` pixels. By default 10.
+    return_stats : bool, optional
+        Whether to also return the statistics of the solution, by default False.
+    uniform : int, optional
+        If given, the image asterisms are only built from `uniform` sources of
+        `pixel_coords` spread over the field, taking the brightest ones round-robin
+        over the cells of a grid (see :func:`twirl.geometry.uniformize`), while the
+        `radecs` ones are built from the brightest sources. `pixel_coords` must
+        then be sorted by decreasing brightness. This allows to solve with fewer
+        asterisms than selecting the brightest sources, which often bunch up in a
+        part of the field. By default None.
+    hash_grid : bool, optional
+        Whether to look up the `radecs` hashes in a quantized hash grid rather than
+        a KD-tree, see :func:`twirl.match.find_transform`. By default False.
+    time_budget : float, optional
+        Maximum duration of the asterisms search in seconds, after which the best
+        transform found so far is used. By default None.
+    max_hypotheses : int, optional
+        Maximum number of candidate transforms tested by the asterisms search,
+        after which the best transform found so far is used. By default None.
 
     Returns
     -------
@@ -52,33 +155,131 @@ def compute_wcs(
         WCS solution for the image if a match can be computed, None otherwise.
         A match is considered to be computed if at least one source and one target
         star are located less than `tolerance` pixels away from each other.
+    dict
+        Only if `return_stats` is True, the residuals statistics of the solution
+        (see :func:`twirl.match.refine_transform`), the search statistics (see
+        :func:`twirl.match.find_transform`) and ``cached``, whether the solution
+        comes from `cache`. For a cached solution, ``match_fraction`` is the
+        fraction of `pixel_coords` cross-matched by the cached WCS and no
+        hypotheses are tested.
     """
     original_radecs = radecs.copy()
     center = SkyCoord(*radecs.mean(0), unit="deg")
-    radecs = _project_tangent_plane(center, SkyCoord(radecs, unit="deg")).T
-
-    M = find_transform(
-        radecs,
-        pixel_coords,
-        tolerance=tolerance,
-        asterism=asterism,
-        min_match=min_match,
-        quads_tolerance=quads_tolerance,
-    )
-    if M is None:
-        return None
+    if index is None:
+        radecs = _project_tangent_plane(center, SkyCoord(radecs, unit="deg")).T
     else:
-        radecs_xy = (M @ pad(radecs).T)[0:2].T
-        i, j = cross_match(pixel_coords, radecs_xy).T
-        M = get_transform_matrix(radecs[j], pixel_coords[i])
-        radecs_xy = (M @ pad(radecs).T)[0:2].T
-        i, j = cross_match(pixel_coords, radecs_xy).T
-        return fit_wcs_from_points(
-            pixel_coords[i].T, SkyCoord(original_radecs[j], unit="deg")
+        radecs = index.coords
+
+    wcs = None
+    stats = dict(rms=np.inf, n_matches=0, iterations=0, converged=False)
+
+    if cache is not None:
+        key = cache.key(center, pixel_coords)
+        cached = cache.get(key)
+        if cached is not None:
+            start = time.perf_counter()
+            radecs_xy = np.array(
+                cached.world_to_pixel(SkyCoord(original_radecs, unit="deg"))
+            ).T
+            match = count_cross_match(pixel_coords, radecs_xy, tolerance)
+            # without `min_match`, any cached solution that can be fitted is used
+            required = 3 if min_match is None else min_match * len(pixel_coords)
+            if match >= max(required, 3):
+                i, j = cross_match(pixel_coords, radecs_xy, tolerance).T
+                M = get_transform_matrix(radecs[j], pixel_coords[i])
+                wcs, stats = _fit_wcs(
+                    pixel_coords,
+                    radecs,
+                    original_radecs,
+                    M,
+                    2 * tolerance,
+                    max_iterations,
+                )
+                # the same statistics as a search, that did not hash anything
+                stats.update(
+                    match_fraction=match / len(pixel_coords),
+                    hypotheses=0,
+                    exhaustive=True,
+                    elapsed=time.perf_counter() - start,
+                    asterism=asterism if index is None else index.asterism,
+                    n_stars=0,
+                    capped=False,
+                    flipped=bool(np.linalg.det(M[0:2, 0:2]) < 0),
+                    cached=True,
+                )
+
+    if wcs is None:
+        M, search_stats = find_transform(
+            radecs,
+            pixel_coords,
+            tolerance=tolerance,
+            asterism=asterism,
+            min_match=min_match,
+            quads_tolerance=quads_tolerance,
+            index=index,
+            max_memory=max_memory,
+            uniform=uniform,
+            hash_grid=hash_grid,
+            time_budget=time_budget,
+            max_hypotheses=max_hypotheses,
+            return_stats=True,
         )
+        if M is not None:
+            wcs, stats = _fit_wcs(
+                pixel_coords,
+                radecs,
+                original_radecs,
+                M,
+                2 * tolerance,
+                max_iterations,
+            )
+        stats.update(search_stats, cached=False)
 
+        if cache is not None and wcs is not None:
+            cache.put(key, wcs)
 
-def find_peaks(data: np.ndarray, threshold: float = 2.0) -> np.ndarray:
+    if return_stats:
+        return wcs, stats
+    else:
+        return wcs
+
+
+def _bin_image(data: np.ndarray, binning: int) -> np.ndarray:
+    # mean-bin the image, dropping the rows and columns that do not fill a bin
+    ny, nx = (np.array(data.shape) // binning) * binning
+    blocks = data[:ny, :nx].reshape(ny // binning, binning, nx // binning, binning)
+    binned = blocks.mean(axis=3).mean(axis=1)
+    # nanmean is much slower, only used for the bins containing NaNs
+    if np.isnan(binned).any():
+        binned = np.nanmean(blocks, axis=(1, 3))
+    return binned
+
+
+def _refine_centroid(data, bbox, binning, threshold, margin=2):
+    # weighted centroid of the pixels above threshold in a full resolution cutout
+    # covering the binned region bounding box
+    min_row, min_col, max_row, max_col = bbox
+    y0 = max((min_row - margin) * binning, 0)
+    x0 = max((min_col - margin) * binning, 0)
+    y1 = min((max_row + margin) * binning, data.shape[0])
+    x1 = min((max_col + margin) * binning, data.shape[1])
+    cutout = data[y0:y1, x0:x1]
+    weights = np.where(cutout > threshold, cutout, 0.0)
+    total = np.nansum(weights)
+    if not total > 0:
+        return None
+    y, x = np.indices(cutout.shape)
+    return np.array(
+        [
+            x0 + np.nansum(x * weights) / total,
+            y0 + np.nansum(y * weights) / total,
+        ]
+    )
+
+
+def find_peaks(
+    data: np.ndarray, threshold: float = 2.0, binning: int = 1
+) -> np.ndarray:
     """
     Find the coordinates of the peaks in a 2D array.
 
@@ -90,6 +291,11 @@ def find_peaks(data: np.ndarray, threshold: float = 2.0) -> np.ndarray:
         The threshold (in unit of image standard deviation) above which a pixel is considered
         part of a peak, i.e.
         The default is 2.0.
+    binning : int, optional
+        If larger than 1, peaks are first detected on a ``binning x binning`` binned
+        version of the image and their centroids are then refined on full resolution
+        cutouts. This is much faster on large images and well suited to plate solving,
+        where only bright and well-separated stars are needed. By default 1 (no binning).
 
     Returns
     -------
@@ -97,9 +303,28 @@ def find_peaks(data: np.ndarray, threshold: float = 2.0) -> np.ndarray:
         An array of shape (N, 2) containing the (x, y) coordinates of the N peaks
         found in the input array. The peaks are sorted by decreasing flux.
     """
-    threshold = threshold * np.nanstd(data) + np.nanmedian(data)
-    regions = regionprops(label(data > threshold), data)
-    coordinates = np.array([region.weighted_centroid[::-1] for region in regions])
-    fluxes = np.array([np.sum(region.intensity_image) for region in regions])
+    if binning > 1:
+        binned = _bin_image(data, binning)
+        threshold = threshold * np.nanstd(binned) + np.nanmedian(binned)
+        regions = regionprops(label(binned > threshold), binned)
+        coordinates = []
+        fluxes = []
+        for region in regions:
+            coords = _refine_centroid(data, region.bbox, binning, threshold)
+            if coords is None:
+                # centre of the binned centroid in full resolution pixels
+                coords = (
+                    np.array(region.weighted_centroid[::-1]) * binning
+                    + (binning - 1) / 2
+                )
+            coordinates.append(coords)
+            fluxes.append(np.sum(region.intensity_image))
+        coordinates = np.array(coordinates).reshape(-1, 2)
+        fluxes = np.array(fluxes)
+    else:
+        threshold = threshold * np.nanstd(data) + np.nanmedian(data)
+        regions = regionprops(label(data > threshold), data)
+        coordinates = np.array([region.weighted_centroid[::-1] for region in regions])
+        fluxes = np.array([np.sum(region.intensity_image) for region in regions])
 
     return coordinates[np.argsort(fluxes)[::-1]]